@@ -2,9 +2,11 @@
 # coding:utf-8
 """
 Usage:
-  auto_task [options] cmd <command> [--parallel][--skip-err] target <targets>...
-  auto_task [options] put <src> <dst> [--parallel] target <targets>...
-  auto_task [options] get <src> <dst> target <targets>...
+  auto_task [options] cmd <command> [--parallel][--skip-err][--stream|--aggregate][--output-dir <dir>] target <targets>...
+  auto_task [options] put <src> <dst> [--parallel][--delta|--tar][--fanout <width>][--journal <file> [--trust-journal]] target <targets>...
+  auto_task [options] get <src> <dst> [--parallel][--delta|--tar] target <targets>...
+  auto_task [options] play <stepfile> [--parallel][--skip-err][--stream|--aggregate][--output-dir <dir>][--window <num>][--max-fail <num>] target <targets>...
+  auto_task [options] agent [--idle <seconds>]
 
 
 Options:
@@ -13,15 +15,48 @@ Options:
   -u <user>             Remote username [default: root]
   -p <password>         User's password
   --pkey <private-key>  Local private key [default: ~/.ssh/id_rsa]
-  --parallel            Parallel execution, only use with 'cmd' or 'put' [default: False]
+  --parallel            Parallel execution of hosts [default: False]
+  --slice <k/n>         Only process the k-th of n batches of the targets, hosts are split by hash of hostname (stable across runs)
+  --forks <num>         Max number of hosts processed at the same time when '--parallel' [default: 20]
+  --conn-timeout <sec>  Timeout of connecting (tcp, ssh handshake and authentication) to each server [default: 10]
+  --retries <num>       Retry connecting this many times on transient errors (timeout, refused, reset), with jittered exponential backoff [default: 0]
+  --timeout <sec>       Close the channel of a remote command which runs longer than <sec>, treated as an error, 'timeout' of a step overrides it in 'play'
+  --straggler <factor>  Report servers still running after <factor> times the median time the finished servers took
+  --drop-stragglers     With '--straggler', abort the stragglers (close their connections) instead of waiting for them [default: False]
   --skip-err            When remote command encounter errors on some server(s), continue run on remainder [default: False]
+  --stream              Print output line by line with hostname prefix as soon as it arrives, only use with 'cmd' [default: False]
+  --aggregate           Print each distinct output only once followed by the servers which produced it, only use with 'cmd' [default: False]
+  --output-dir <dir>    Save each server's stdout/stderr to <dir>/<hostname>.out/.err instead of printing, only use with 'cmd'
+  --transfers <num>     Files transferred at the same time for each server, every one over its own sftp channel, only use with 'put' or 'get' [default: 4]
+  --delta               For large files which already exist on the destination, only send the changed blocks, remote server needs python3 [default: False]
+  --tar                 Transfer changed files of a directory as one compressed tar stream over a single exec channel, remote server needs tar [default: False]
+  --fanout <width>      Upload only to the first <width> servers, every server then relays to <width> more servers (tree distribution),
+                        relay uses ssh on the server with agent forwarding, falls back to upload from local if relay fails
+  --journal <file>      Local sqlite file recording files last put to each server, only use with 'put'
+  --trust-journal       Skip remote check for directories whose files are unchanged since last put according to journal [default: False]
+  --verify <ratio>      With '--trust-journal', still check this ratio of unchanged directories on remote [default: 0]
+  --bwlimit <rate>      Max bandwidth of all transfers together, e.g. 20M (bytes per second, K/M/G), caps of groups or subnets
+                        can be set under '_bwlimits' in config, '--tar', '--delta' and relay are not limited
+  --profile <name>      Transport tuning profile: default, lan, wan, compress, wan-compress or one defined under '_profiles' in config,
+                        overrides 'profile' in '_vars' of the groups
+  --window <num>        With 'play', at most <num> servers are in the middle of the steps at the same time (rolling), connections may be made ahead
+  --max-fail <num>      With 'play', stop starting new servers once more than <num> servers failed [default: 0]
+  --stats               Print per-phase timing (p50/p95/max across servers), sftp calls by type and the slowest servers at the end [default: False]
+  --stats-file <file>   Also save the per-server stats to <file>, as Prometheus textfile if it ends with '.prom', otherwise json
+  --agent-sock <path>   Unix socket of the connection agent, connections are reused through it if the agent is running [default: ~/.ssh/auto_task_agent.sock]
+  --idle <seconds>      Agent closes connections which are idle longer than this [default: 300]
 
   cmd                   Run command on remote server(s),multiple commands sperate by ';'
   put                   Transfer from local to remote. Transport mechanism similar to rsync
   get                   Transfer from remote to local. Transport mechanism similar to rsync
-  target                Which host(s) or group(s) you want to process
+                        With multiple servers, each one is saved to <dst>/<hostname>/, or use {hostname} {ip} {port} in <dst> as a template
+  target                Which host(s) or group(s) you want to process, support glob 'web*', regex '~web\d+',
+                        intersection '&group' and exclusion '!host', e.g. 'web:&site1:!web3'
+  play                  Run the steps in YAML <stepfile> (a list of 'cmd: <command>', 'put: [<src>, <dst>]' or 'get: [<src>, <dst>]',
+                        'skip_err: true' and 'timeout: <sec>' are allowed for cmd) on every server in order, over one connection, servers don't wait for each other
+  agent                 Run a local agent holding authenticated connections for later invocations (like ssh ControlMaster)
 
-  Notice:       cmd, get, put can only use one at once.
+  Notice:       cmd, get, put, play can only use one at once.
   For Windows:  Always use double quotes for quote something;
                 It's highly recommend that with get or put in Windows, always use '/' instead of '\\'
 """
@@ -31,14 +66,37 @@ by ljk 20160704
 update at 20171231
 """
 import os
+import re
 import yaml
 import stat
+import json
+import math
+import time
+import zlib
+import shlex
+import hashlib
+import inspect
+import contextlib
+import functools
+import fnmatch
+import io
+import random
+import sqlite3
+import tarfile
+import queue
+import select
+import struct
 import threading
 import socket
+import ipaddress
 from docopt import docopt
 from platform import uname
 from sys import exit, stdout
-from paramiko import SSHClient, AutoAddPolicy
+from paramiko import SSHClient, AutoAddPolicy, SFTPClient, SSHException, AuthenticationException, Transport
+from paramiko.buffered_pipe import BufferedPipe, PipeTimeout
+from paramiko.channel import ChannelFile, ChannelStderrFile, ChannelStdinFile
+from paramiko.util import ClosingContextManager
+from paramiko.agent import AgentRequestHandler
 
 """
 因为涉及了(多)线程,所以将串行也归为单线程,这样可以统一用线程的思路,而不必编写一套多线程模型一套串行模型。
@@ -48,22 +106,46 @@ from paramiko import SSHClient, AutoAddPolicy
 global_lock = threading.Lock()
 computer = uname().system
 event = threading.Event()
+relay_tree = None
+inventory = None
+host_stats = []    # --stats: 各主机的 HostStats
+aggregator = None
+play_steps = None    # play: 步骤列表
+play_window = None    # play --window: 限制同时处于步骤中间的主机数量的信号量
+failed_hosts = []    # play: 失败的主机
+straggler_watch = None
+bw_limits = []    # --bwlimit 及配置文件 _bwlimits: [(名称, TokenBucket, 主机名集合或网段), ...]
+total_lock = threading.Lock()
+transfer_total = [0, 0]    # 所有主机合计传输的 文件数, 字节数
 INDENT_1 = 0 * ' '
 INDENT_2 = 4 * ' '
 INDENT_3 = 8 * ' '
+STREAM_LINE_MAX = 64 * 1024    # 流式输出时, 单行最多缓存的字节数
+DELTA_MIN_SIZE = 1024 * 1024    # 小于此大小的文件直接完整传输
+DELTA_SCAN_MIN = 64 * 1024 * 1024    # 差异传输至少扫描 min(此大小, 文件的10%) 后才按字面数据的比例决定是否放弃
+RESUME_MIN_SIZE = 32 * 1024 * 1024    # 不小于此大小的文件经临时文件传输, 中断后可以续传
+RESUME_CHUNK = 4 * 1024 * 1024    # 续传时按此大小分块校验
+RETRY_BASE_DELAY = 1    # 重连的退避时间: 第n次重试前随机等待 0 ~ min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2^(n-1)) 秒
+RETRY_MAX_DELAY = 30
 
 
 class OutputText:
     """该类具有write()方法,用来存储每台server的执行结果.
     因为引入了多线程异步执行才需要这么做,以保证异步执行多台server的输出不会乱.
     为了简洁,并行与串行的输出都用这一套东西"""
-    def __init__(self):
+    def __init__(self, hostname=None):
+        self.hostname = hostname
         self.buffer = []
+        self.lock = threading.Lock()    # 同一台server内也可能有多个传输线程同时输出
 
     def write_or_print(self, *args, color=None):
         """并行模式先缓存最后加锁输出; 串行模式直接输出"""
         # print(args)  # debug 可观察到并行时内部各输出的产生顺序
-        if arguments['--parallel']:
+        with self.lock:
+            self._write_or_print(*args, color=color)
+
+    def _write_or_print(self, *args, color=None):
+        if arguments['--parallel'] or aggregator:
             if color and not computer == 'Windows':
                 self.buffer.append('\033[0;{}m'.format(color))
                 self.buffer.extend(args)
@@ -78,11 +160,15 @@ class OutputText:
                     print(string, end='')
 
     def print_lock(self):
-        """并发模式下,所有的输出动作都要加锁"""
-        if self.buffer:
+        """并发模式下,所有的输出动作都要加锁; 汇总模式下交给汇总线程"""
+        if aggregator:
+            aggregator.submit(self.hostname, ''.join(self.buffer))
+            self.buffer = []
+        elif self.buffer:
             with global_lock:
                 for line in self.buffer:
                     print(line, end='')
+            self.buffer = []    # play模式下每个步骤都会输出一次
 
     @staticmethod
     def print_color(text, color=31, sep=' ', end='\n', file=stdout, flush=False):
@@ -96,45 +182,1135 @@ class OutputText:
             print('\033[0m', end='')
 
 
+class OutputAggregator:
+    """--aggregate: 各主机的完整输出经队列交给唯一的汇总线程, 按内容的hash归并,
+    只保留每种不同的输出一份及产生它的主机名, 内存占用与不同输出的数量相关, 与主机数量无关.
+    全部结束后依次输出每种结果及其主机列表(主机多的在前)"""
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.results = {}    # hash -> [输出, [主机名...]]
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    def submit(self, hostname, text):
+        self.queue.put((hostname, text))
+
+    def _run(self):
+        for hostname, text in iter(self.queue.get, None):
+            digest = hashlib.sha1(text.encode('utf-8', 'replace')).digest()
+            result = self.results.get(digest)
+            if result is None:
+                self.results[digest] = [text, [hostname]]
+            else:
+                result[1].append(hostname)
+
+    def close(self):
+        """等待汇总线程处理完队列, 输出汇总结果"""
+        self.queue.put(None)
+        self.thread.join()
+        for text, hostnames in sorted(self.results.values(), key=lambda r: (-len(r[1]), r[1])):
+            OutputText.print_color('\n{}----{} hosts: {}'.format(INDENT_1, len(hostnames), compact_hosts(hostnames)), color=33)
+            print(text, end='')
+
+
+def compact_hosts(hostnames):
+    """将主机名列表压缩为紧凑形式, 如 web1 web2 web3 web5 db01 db02 -> db[01-02],web[1-3,5]"""
+    numbered, others = {}, []
+    for name in hostnames:
+        m = re.match(r'(.*?)(\d+)$', name)
+        if m:
+            digits = m.group(2)
+            width = len(digits) if digits.startswith('0') and len(digits) > 1 else 0
+            numbered.setdefault((m.group(1), width), []).append(int(digits))
+        else:
+            others.append(name)
+    parts = []
+    for (prefix, width), numbers in numbered.items():
+        numbers.sort()
+        ranges, start = [], numbers[0]
+        for prev, cur in zip(numbers, numbers[1:] + [None]):
+            if cur is None or cur != prev + 1:
+                ranges.append(str(start).zfill(width) if start == prev else '{}-{}'.format(str(start).zfill(width), str(prev).zfill(width)))
+                start = cur
+        parts.append(prefix + ranges[0] if len(numbers) == 1 else '{}[{}]'.format(prefix, ','.join(ranges)))
+    return ','.join(sorted(parts + others))
+
+
+def human_size(size):
+    """字节数转换为便于阅读的形式"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024
+    return '{:.1f}TB'.format(size)
+
+
+def parse_size(value):
+    """'20M', '512k', '1.5G/s' 等转换为字节数(1024进制), 纯数字为字节数"""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?(?:/s)?\s*$', str(value), re.I)
+    if not match:
+        raise ValueError('invalid size: {}'.format(value))
+    return float(match.group(1)) * 1024 ** ' kmgt'.index(match.group(2).lower() or ' ')
+
+
+class TokenBucket:
+    """线程安全的令牌桶: 每秒补充 rate 字节, 最多积攒 burst 字节.
+    consume()先扣除令牌, 不足时记为欠账, 返回欠账还清所需的秒数, 调用方睡眠这么久, 因此多个线程共用时总速率不超过 rate"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate / 10, 64 * 1024)    # 约0.1秒的流量, 避免每个小块都睡眠
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - size
+            self.stamp = now
+            return -self.tokens / self.rate
+
+
+def load_bwlimits():
+    """--bwlimit 为所有主机合计的上限; 配置文件顶层 _bwlimits 中 组名/主机名/网段(如10.1.0.0/16) -> 速率,
+    为其下所有主机合计的上限, 同一主机同时受所有匹配的上限约束"""
+    limits = []
+    if arguments['--bwlimit']:
+        limits.append(('total', TokenBucket(parse_size(arguments['--bwlimit'])), None))
+    for name, rate in (inventory.settings.get('_bwlimits') or {}).items():
+        name = str(name)
+        try:
+            members = ipaddress.ip_network(name, strict=False) if '/' in name else inventory.select(name)
+        except ValueError:
+            members = set()
+        if not members:
+            raise ValueError('{} in _bwlimits is neither a group, a host nor a subnet'.format(name))
+        limits.append((name, TokenBucket(parse_size(rate)), members))
+    return limits
+
+
+def host_buckets(hostname, ip):
+    """主机受约束的 [(名称, TokenBucket), ...]"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        address = None    # 配置中写的是域名时不参与网段匹配
+    ret = []
+    for name, bucket, members in bw_limits:
+        if members is None or (hostname in members if isinstance(members, set) else address in members):
+            ret.append((name, bucket))
+    return ret
+
+
+TRANSPORT_PROFILES = {
+    # paramiko的默认值: 窗口2MB, 最大包32KB, 不压缩
+    'default': {},
+    # 局域网: 优先使用有硬件加速的AES(GCM省去单独的MAC计算), 带宽高延迟低, 加密是主要开销
+    'lan': {'ciphers': ['aes128-gcm@openssh.com', 'aes128-ctr'], 'macs': ['hmac-sha2-256-etm@openssh.com', 'hmac-sha2-256'],
+            'window_size': 8 * 1024 * 1024},
+    # 高延迟的跨地域链路: 窗口需要大于 带宽*延迟, 否则吞吐量被窗口限制
+    'wan': {'window_size': 64 * 1024 * 1024, 'max_packet_size': 256 * 1024},
+    # 日志, 配置文件等容易压缩的内容
+    'compress': {'compress': True},
+    'wan-compress': {'compress': True, 'window_size': 64 * 1024 * 1024, 'max_packet_size': 256 * 1024},
+}
+
+
+def profile_connect_args(profile):
+    """profile中 压缩, 加密算法, MAC算法 的设置转换为 SSHClient.connect() 的参数.
+    加密和MAC算法按列出的顺序优先, 且只使用列出的算法(paramiko 3.2之前没有transport_factory, 只能禁用列表之外的算法)"""
+    args = {'compress': bool(profile.get('compress'))}
+    # profile中的键 --> (SecurityOptions的属性, disabled_algorithms的键, 所有已知算法, 默认顺序)
+    preferred = {option: (key, [name for name in profile[key] if name in known], default) for key, option, known, default in
+                 (('ciphers', 'ciphers', Transport._cipher_info, Transport._preferred_ciphers),
+                  ('macs', 'digests', Transport._mac_info, Transport._preferred_macs)) if profile.get(key)}
+    if not preferred:
+        return args
+    if 'transport_factory' in inspect.signature(SSHClient.connect).parameters:
+        def transport_factory(*a, **kw):
+            transport = Transport(*a, **kw)
+            options = transport.get_security_options()
+            for option, (_, names, _) in preferred.items():
+                setattr(options, option, names)
+            return transport
+        args['transport_factory'] = transport_factory
+    else:
+        args['disabled_algorithms'] = {key: [name for name in default if name not in names] for key, names, default in preferred.values()}
+    return args
+
+
+def tune_transport(transport, profile):
+    """之后在此 Transport 上开启的channel(exec, sftp)使用profile中的窗口和最大包大小"""
+    if transport and profile.get('window_size'):
+        transport.default_window_size = int(profile['window_size'])
+    if transport and profile.get('max_packet_size'):
+        transport.default_max_packet_size = int(profile['max_packet_size'])
+
+
+def host_profile(hostname):
+    """返回主机使用的 (profile名称, profile): --profile, 其次组的 _vars 中的 profile, 否则为default"""
+    entry = inventory.hosts.get(hostname) if inventory else None
+    name = arguments['--profile'] or (entry and entry[3].get('profile')) or 'default'
+    profiles = dict(TRANSPORT_PROFILES, **(inventory.settings.get('_profiles') or {} if inventory else {}))
+    return name, profiles.get(name)
+
+
+class HostStats:
+    """--stats: 单台主机各阶段的耗时, 按类型统计的sftp调用次数和耗时"""
+    PHASES = ('tcp', 'kex', 'auth', 'connect', 'exec', 'transfer')
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.phases = {}
+        self.sftp_calls = {}    # 类型 -> [次数, 耗时]
+        self.files = self.bytes = 0
+        self.ok = False
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def add_call(self, op, seconds):
+        with self.lock:
+            call = self.sftp_calls.setdefault(op, [0, 0])
+            call[0] += 1
+            call[1] += seconds
+
+    @property
+    def total(self):
+        return sum(self.phases.get(phase, 0) for phase in ('connect', 'exec', 'transfer'))
+
+    def to_dict(self):
+        return {'ok': self.ok, 'phases': {k: round(v, 6) for k, v in self.phases.items()}, 'files': self.files, 'bytes': self.bytes,
+                'sftp_calls': {op: {'count': c, 'seconds': round(t, 6)} for op, (c, t) in self.sftp_calls.items()}}
+
+
+def timed(phase):
+    """--stats: 记录 AutoTask 方法的耗时为 phase 阶段, 方法以exit()结束时同样记录"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.stats is None:
+                return func(self, *args, **kwargs)
+            start = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.stats.add(phase, time.time() - start)
+        return wrapper
+    return decorator
+
+
+class CountedSFTP:
+    """--stats: 包装 SFTPClient, 按类型统计调用次数和耗时, 其余属性直接转发"""
+    OPS = {'stat': 'stat', 'lstat': 'stat', 'put': 'put', 'get': 'get', 'utime': 'utime', 'chmod': 'chmod', 'mkdir': 'mkdir',
+           'listdir': 'listdir', 'listdir_attr': 'listdir', 'open': 'open', 'rename': 'rename', 'posix_rename': 'rename', 'remove': 'remove'}
+
+    def __init__(self, sftp, stats):
+        self._sftp = sftp
+        self._stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self._sftp, name)
+        op = self.OPS.get(name)
+        if op is None:
+            return attr
+
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._stats.add_call(op, time.time() - start)
+        return call
+
+
+def percentile(values, p):
+    """最近秩法的百分位数, values已排序"""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def report_stats(stats_list):
+    """--stats: 输出各阶段耗时和sftp调用在所有主机间的 p50/p95/max, 以及最慢的主机"""
+    rows = []
+    for phase in HostStats.PHASES:
+        values = sorted(s.phases[phase] for s in stats_list if phase in s.phases)
+        if values:
+            rows.append((phase + '(s)', values))
+    for op in sorted({op for s in stats_list for op in s.sftp_calls}):
+        rows.append(('sftp.{}(n)'.format(op), sorted(s.sftp_calls.get(op, [0])[0] for s in stats_list)))
+        rows.append(('sftp.{}(s)'.format(op), sorted(s.sftp_calls.get(op, [0, 0])[1] for s in stats_list)))
+    rows.append(('bytes', sorted(s.bytes for s in stats_list)))
+    lines = ['\n{}----stats: {} hosts'.format(INDENT_1, len(stats_list)),
+             '{}{:<20}{:>12}{:>12}{:>12}'.format(INDENT_2, '', 'p50', 'p95', 'max')]
+    for name, values in rows:
+        lines.append('{}{:<20}{:>12.4g}{:>12.4g}{:>12.4g}'.format(INDENT_2, name, percentile(values, 50), percentile(values, 95), values[-1]))
+    lines.append('{}----slowest hosts:'.format(INDENT_2))
+    for s in sorted(stats_list, key=lambda s: s.total, reverse=True)[:5]:
+        detail = ', '.join('{} {:.3f}s'.format(phase, s.phases[phase]) for phase in HostStats.PHASES if phase in s.phases)
+        lines.append('{}{:<20}{:>8.3f}s  ({})'.format(INDENT_3, s.hostname, s.total, detail))
+    with global_lock:
+        print('\n'.join(lines))
+
+
+def save_stats(stats_list, path):
+    """--stats-file: '.prom' 结尾时写为Prometheus的textfile格式(供node_exporter收集), 否则为json; 先写临时文件再改名"""
+    if path.endswith('.prom'):
+        metrics = [('auto_task_phase_seconds', 'Seconds spent in each phase', []),
+                   ('auto_task_sftp_calls', 'SFTP calls by type in the last run', []),
+                   ('auto_task_sftp_seconds', 'Seconds spent in SFTP calls by type in the last run', []),
+                   ('auto_task_transferred_files', 'Files transferred', []),
+                   ('auto_task_transferred_bytes', 'Bytes transferred', []),
+                   ('auto_task_success', 'Whether the task succeeded on the host', [])]
+        for s in stats_list:
+            host = 'host="{}"'.format(s.hostname.replace('\\', '\\\\').replace('"', '\\"'))
+            metrics[0][2].extend('{{{},phase="{}"}} {:.6f}'.format(host, k, v) for k, v in s.phases.items())
+            metrics[1][2].extend('{{{},op="{}"}} {}'.format(host, op, c) for op, (c, _) in s.sftp_calls.items())
+            metrics[2][2].extend('{{{},op="{}"}} {:.6f}'.format(host, op, t) for op, (_, t) in s.sftp_calls.items())
+            metrics[3][2].append('{{{}}} {}'.format(host, s.files))
+            metrics[4][2].append('{{{}}} {}'.format(host, s.bytes))
+            metrics[5][2].append('{{{}}} {}'.format(host, int(s.ok)))
+        lines = []
+        for name, help_, samples in metrics:
+            lines += ['# HELP {} {}'.format(name, help_), '# TYPE {} gauge'.format(name)] + [name + sample for sample in samples]
+        content = '\n'.join(lines) + '\n'
+    else:
+        content = json.dumps({'hosts': {s.hostname: s.to_dict() for s in stats_list}}, indent=2, sort_keys=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+class StragglerWatch:
+    """--straggler: 成功完成的主机达到 min_done 台后, 每秒检查一次仍在运行的主机,
+    运行时间超过其耗时中位数的 factor 倍(至少1秒)的视为掉队者, 立即提示;
+    --drop-stragglers 时中止掉队者, 使整体耗时取决于策略而不是最慢的主机"""
+    def __init__(self, factor, drop, min_done):
+        self.factor = factor
+        self.drop = drop
+        self.min_done = min_done
+        self.running = {}    # 主机名 -> (开始时间, AutoTask)
+        self.durations = []    # 已完成的非掉队主机的耗时
+        self.stragglers = []    # 主机名
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def begin(self, auto_task):
+        with self.lock:
+            self.running[auto_task.hostname] = (time.time(), auto_task)
+
+    def end(self, hostname, ok):
+        """ok: 主机是否成功完成; 很快出错的主机(如连接失败, 命令出错)会拉低中位数, 不计入"""
+        with self.lock:
+            start, _ = self.running.pop(hostname)
+            if ok and hostname not in self.stragglers:
+                self.durations.append(time.time() - start)
+
+    def _run(self):
+        while not self.stopped.wait(1):
+            self._check()
+
+    def _check(self):
+        with self.lock:
+            if len(self.durations) < self.min_done:
+                return
+            median = percentile(sorted(self.durations), 50)
+            threshold = max(median * self.factor, 1)
+            now = time.time()
+            late = [(hostname, now - start, auto_task) for hostname, (start, auto_task) in self.running.items()
+                    if now - start > threshold and hostname not in self.stragglers]
+            self.stragglers.extend(hostname for hostname, _, _ in late)
+        for hostname, elapsed, auto_task in late:
+            with global_lock:
+                OutputText.print_color('\n{}----straggler: {} running for {:.1f}s, median of finished servers {:.1f}s{}'.format(
+                    INDENT_1, hostname, elapsed, median, ', dropped' if self.drop else ''), color=33)
+            if self.drop:
+                auto_task.abort()
+
+    def close(self):
+        self.stopped.set()
+
+
+class TransferPool:
+    """单台server内的并发传输: 在同一个 Transport 上另外开启多个sftp channel, 每个channel由一个线程负责,
+    同时最多有 size 个文件在传输, 使大量小文件的传输不再受限于逐个文件的往返延迟.
+    大文件本身由paramiko的 prefetch(get) 和 pipelined 写(put) 处理.
+    部分channel开启失败(如超过了服务端的MaxSessions)时用已开启的channel继续; 一个都没有则本主机出错.
+    任一文件出错时, 退出with块时在调用方线程 exit(), 与串行传输出错时的行为一致"""
+    def __init__(self, auto_task, size):
+        self.auto_task = auto_task
+        self.queue = queue.Queue(maxsize=size * 4)
+        self.failed = False
+        self.errors = []
+        self.opened = threading.Barrier(size + 1)    # 等待所有线程开启channel(成功或失败)
+        self.threads = [threading.Thread(target=self._run) for _ in range(size)]
+        for t in self.threads:
+            t.start()
+        self.opened.wait()
+        opened = size - len(self.errors)
+        output = auto_task.output
+        if not opened:
+            output.write_or_print('%sopen_sftp error: %s\n' % (INDENT_3, self.errors[0]), color=31)
+            output.print_lock()
+            auto_task.event.set()
+            exit()
+        if self.errors:
+            output.write_or_print('%sopen_sftp error: %s, using %s of %s channels\n' % (INDENT_3, self.errors[0], opened, size), color=33)
+
+    def _run(self):
+        try:
+            sftp = self.auto_task.open_sftp()
+        except Exception as err:
+            self.errors.append(err)
+            self.opened.wait()
+            return
+        self.opened.wait()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.auto_task.event.is_set():    # 出错后只消耗队列, 不再传输
+                continue
+            func, args, kwargs = item
+            try:
+                func(*args, sftp=sftp, **kwargs)
+            except SystemExit:    # func内部已输出错误并设置了event
+                self.failed = True
+            except Exception as err:
+                self.auto_task.output.write_or_print('%s%s: %s\n' % (INDENT_3, func.__name__, err), color=31)
+                self.auto_task.event.set()
+                self.failed = True
+        sftp.close()
+
+    def submit(self, func, *args, **kwargs):
+        self.queue.put((func, args, kwargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        if self.failed and exc_type is None:
+            self.auto_task.output.print_lock()
+            exit()
+
+
+class DeltaAborted(Exception):
+    """差异数据过多(文件大部分内容已改变), 放弃差异传输, 改为完整传输"""
+
+
+def delta_block_size(size):
+    """参照rsync: 块大小约为文件大小的平方根, 限制在 [2KB, 128KB]"""
+    return min(max(int(size ** 0.5) // 1024 * 1024, 2048), 128 * 1024)
+
+
+def delta_min_scan(size):
+    """delta_make() 按字面数据比例放弃之前至少扫描的字节数"""
+    return min(DELTA_SCAN_MIN, size // 10)
+
+
+def delta_sign(f, block_size, out):
+    """接收端: 对已有文件逐块计算 弱校验(adler32, 可滚动) + 强校验(md5), 每块20字节写入out"""
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        out.write(struct.pack('>I', zlib.adler32(block)) + hashlib.md5(block).digest())
+
+
+def delta_make(f, signature, block_size, out, limit, min_scan):
+    """发送端: 以滚动校验在新文件中查找接收端已有的块, 写出 块引用(C) 和 字面数据(L) 组成的差异流, 以E结束.
+    匹配成功时整块跳过(由C实现的zlib计算), 只有在改变的区域才逐字节滚动.
+    字面数据超过limit字节, 或已扫描至少min_scan字节且其中一半以上是字面数据时, 抛出 DeltaAborted, 改为完整传输.
+    逐字节滚动很慢, 完全改变的大文件应尽早放弃; 扫描足够多后才按比例判断, 文件开头的改动(如重写的文件头)不会使差异传输被放弃"""
+    table = {}
+    for i in range(0, len(signature), 20):
+        weak = struct.unpack('>I', signature[i:i + 4])[0]
+        table.setdefault(weak, {}).setdefault(signature[i + 4:i + 20], i // 20)
+    state = {'run': None, 'literal': 0}
+
+    def flush_run():
+        if state['run']:
+            out.write(b'C' + struct.pack('>II', *state['run']))
+            state['run'] = None
+
+    def emit_literal(data):
+        if data:
+            flush_run()
+            state['literal'] += len(data)
+            if state['literal'] > limit:
+                raise DeltaAborted()
+            out.write(b'L' + struct.pack('>I', len(data)) + bytes(data))
+
+    def emit_copy(index):
+        run = state['run']
+        if run and run[0] + run[1] == index:
+            run[1] += 1
+        else:
+            flush_run()
+            state['run'] = [index, 1]
+
+    buf, eof = f.read(block_size * 64), False
+    pos = lit_start = offset = 0    # offset: buf[0] 在文件中的位置
+    weak = a = b = None
+    while True:
+        if not eof and len(buf) - pos <= block_size:
+            # 窗口后至少要再有一个字节用于滚动; 补充数据前先写出已确定的字面数据
+            emit_literal(buf[lit_start:pos])
+            if offset + pos >= min_scan and state['literal'] * 2 > offset + pos:
+                raise DeltaAborted()
+            more = f.read(block_size * 64)
+            eof = not more
+            buf, offset, pos, lit_start = buf[pos:] + more, offset + pos, 0, 0
+            continue
+        n = min(block_size, len(buf) - pos)
+        if n == 0:
+            break
+        if weak is None or n < block_size:
+            weak = zlib.adler32(buf[pos:pos + n])
+            a, b = weak & 0xffff, weak >> 16
+        index = table[weak].get(hashlib.md5(buf[pos:pos + n]).digest()) if weak in table else None
+        if index is not None:
+            emit_literal(buf[lit_start:pos])
+            emit_copy(index)
+            pos += n
+            lit_start = pos
+            weak = None
+        elif n < block_size or pos + n >= len(buf):
+            # 已到文件末尾且不匹配, 剩余部分都是字面数据
+            pos = len(buf)
+            break
+        else:
+            out_b, in_b = buf[pos], buf[pos + n]
+            a = (a - out_b + in_b) % 65521
+            b = (b - n * out_b + a - 1) % 65521
+            weak = (b << 16) | a
+            pos += 1
+    emit_literal(buf[lit_start:pos])
+    flush_run()
+    out.write(b'E')
+    return state['literal']
+
+
+def delta_patch(basis, delta, out, block_size):
+    """接收端: 依据差异流, 从已有文件(basis)复制块或写入字面数据, 重建新文件.
+    返回收到的字面数据字节数, 差异流不完整时返回None"""
+    literal = 0
+    while True:
+        kind = delta.read(1)
+        if kind == b'C':
+            start, count = struct.unpack('>II', delta.read(8))
+            basis.seek(start * block_size)
+            for _ in range(count):
+                out.write(basis.read(block_size))
+        elif kind == b'L':
+            size = struct.unpack('>I', delta.read(4))[0]
+            data = delta.read(size)
+            if len(data) < size:
+                return None
+            out.write(data)
+            literal += size
+        elif kind == b'E':
+            return literal
+        else:
+            return None
+
+
+def chunk_hashes(f, chunk, count):
+    """文件开头 count 个完整块各自的md5, 用于续传前校验已传输的部分"""
+    hashes = []
+    for _ in range(count):
+        data = f.read(chunk)
+        if len(data) < chunk:
+            break
+        hashes.append(hashlib.md5(data).hexdigest())
+    return hashes
+
+
+DELTA_HELPER_MAIN = '''
+def main():
+    mode, path, block_size = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    stdin, stdout = getattr(sys.stdin, 'buffer', sys.stdin), getattr(sys.stdout, 'buffer', sys.stdout)
+    if mode == 'sign':
+        with open(path, 'rb') as f:
+            delta_sign(f, block_size, stdout)
+    elif mode == 'delta':
+        with open(path, 'rb') as f:
+            try:
+                delta_make(f, stdin.read(), block_size, stdout, int(sys.argv[4]), int(sys.argv[5]))
+            except DeltaAborted:
+                sys.exit(3)
+    elif mode == 'patch':
+        tmp = os.path.join(os.path.dirname(path), '.%s.auto_task.delta' % os.path.basename(path))
+        with open(path, 'rb') as basis, open(tmp, 'wb') as out:
+            literal = delta_patch(basis, stdin, out, block_size)
+        if literal is None:
+            os.remove(tmp)
+            sys.exit(1)
+        os.chmod(tmp, int(sys.argv[4]))
+        os.utime(tmp, (float(sys.argv[5]), float(sys.argv[6])))
+        os.rename(tmp, path)
+    elif mode == 'hashes':
+        with open(path, 'rb') as f:
+            stdout.write('\\n'.join(chunk_hashes(f, block_size, int(sys.argv[4]))).encode())
+main()
+'''
+
+
+def delta_helper_command(*args):
+    """生成在远端执行的差异传输辅助程序命令. 程序由本模块中的差异函数源码拼接而成, 远端只需要有python3"""
+    source = '\n'.join(['import sys, os, zlib, hashlib, struct'] +
+                       [inspect.getsource(obj) for obj in (DeltaAborted, delta_sign, delta_make, delta_patch, chunk_hashes)] +
+                       [DELTA_HELPER_MAIN])
+    return ' '.join(['python3', '-c', shlex.quote(source)] + [shlex.quote(str(arg)) for arg in args])
+
+
+class SyncJournal:
+    """在本地sqlite中记录每台server每个目标根目录下, 最近一次put成功的文件(相对路径, 大小, mtime; 目录以'/'结尾).
+    只加载本次 (host, root) 的记录, 上万条记录也能很快载入; 新的记录在传输结束后一次性写入"""
+    def __init__(self, db_path, host, root):
+        self.db_path = db_path
+        self.host = host
+        self.root = root
+        self.lock = threading.Lock()
+        self.updates = {}
+        with self._connect() as conn:
+            self.entries = {path: (size, mtime) for path, size, mtime in conn.execute(
+                'SELECT path, size, mtime FROM journal WHERE host = ? AND root = ?', (host, root))}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        conn.execute('CREATE TABLE IF NOT EXISTS journal (host TEXT, root TEXT, path TEXT, size INTEGER, mtime INTEGER, '
+                     'PRIMARY KEY (host, root, path)) WITHOUT ROWID')
+        return conn
+
+    def _relpath(self, path_):
+        return path_[len(self.root):]
+
+    def unchanged(self, path_, local_stat):
+        """path_为目标端全路径, local_stat为对应的本地文件stat"""
+        return self.entries.get(self._relpath(path_)) == (local_stat.st_size, int(local_stat.st_mtime))
+
+    def has_dir(self, path_):
+        return self._relpath(path_).rstrip('/') + '/' in self.entries
+
+    def record(self, path_, local_stat):
+        with self.lock:
+            self.updates[self._relpath(path_)] = (local_stat.st_size, int(local_stat.st_mtime))
+
+    def record_dir(self, path_):
+        with self.lock:
+            self.updates[self._relpath(path_).rstrip('/') + '/'] = (0, 0)
+
+    def save(self):
+        if not self.updates:
+            return
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)',
+                             [(self.host, self.root, path_, size, mtime) for path_, (size, mtime) in self.updates.items()])
+        self.entries.update(self.updates)
+        self.updates = {}
+
+
+class RelayTree:
+    """put的树状分发(--fanout): 前 width 台server由本地上传, 之后第i台server由第 (i - width) // width 台server转发,
+    每台server最多向 width 台server转发, 本地的出口流量与server数量无关.
+    主机按层次顺序入队, 子节点被取出时其父节点必然已经开始处理, 所以等待父节点不会造成工作线程死锁"""
+    def __init__(self, hosts, width):
+        self.parents = {}
+        self.done = {host[0]: threading.Event() for host in hosts}
+        self.ok = set()
+        for i, host in enumerate(hosts):
+            if i >= width:
+                self.parents[host[0]] = hosts[(i - width) // width]
+
+    def finish(self, hostname, ok):
+        if ok:
+            self.ok.add(hostname)
+        self.done[hostname].set()
+
+    def wait_parent(self, hostname):
+        """等待父节点完成, 返回父节点(hostname, ip, port); 父节点失败或本身是种子节点时返回None"""
+        parent = self.parents.get(hostname)
+        if parent is None:
+            return None
+        self.done[parent[0]].wait()
+        return parent if parent[0] in self.ok else None
+
+
+class AgentUnavailable(Exception):
+    """本地agent不存在或无法连接, 调用方应回退为直连"""
+
+
+def _send_frame(sock, kind, data=b''):
+    """agent与客户端之间exec通道的帧格式: 1字节类型 + 4字节长度 + 数据"""
+    sock.sendall(kind + struct.pack('>I', len(data)) + data)
+
+
+def _recv_frame(rfile):
+    head = rfile.read(5)
+    if len(head) < 5:
+        return None, b''
+    size = struct.unpack('>I', head[1:])[0]
+    return head[:1], rfile.read(size) if size else b''
+
+
+class AgentSocket(socket.socket):
+    """到agent的unix连接. SFTPClient 直接运行在其上时, 记录日志需要 get_name(), 流水线写入需要 recv_ready()"""
+    def get_name(self):
+        return 'agent:{}'.format(self.fileno())
+
+    def recv_ready(self):
+        """SFTPFile 流水线写入的未确认请求较多时调用, 检查是否已有响应可读"""
+        return bool(select.select([self], [], [], 0)[0])
+
+
+class AgentChannel:
+    """在客户端一侧模拟 paramiko Channel 的常用接口, 实际数据经由unix socket与agent中的真实Channel交换.
+    这样 ChannelFile 等上层对象可以不加区分地使用"""
+    def __init__(self, sock, rfile):
+        self.sock = sock
+        self.timeout = None
+        self.in_buffer = BufferedPipe()
+        self.in_stderr_buffer = BufferedPipe()
+        self.exit_status = -1
+        self.status_event = threading.Event()
+        self.send_lock = threading.Lock()
+        threading.Thread(target=self._reader, args=(rfile,), daemon=True).start()
+
+    def _reader(self, rfile):
+        """后台线程: 按帧类型分拣 stdout/stderr/退出码"""
+        try:
+            while True:
+                kind, data = _recv_frame(rfile)
+                if kind is None:
+                    break
+                if kind == b'o':
+                    self.in_buffer.feed(data)
+                elif kind == b'e':
+                    self.in_stderr_buffer.feed(data)
+                elif kind == b'x':
+                    self.exit_status = struct.unpack('>i', data)[0]
+                    break
+        except OSError:
+            pass
+        finally:
+            self.in_buffer.close()
+            self.in_stderr_buffer.close()
+            self.status_event.set()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def _read(self, buffer, nbytes):
+        try:
+            return buffer.read(nbytes, self.timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv(self, nbytes):
+        return self._read(self.in_buffer, nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self._read(self.in_stderr_buffer, nbytes)
+
+    def recv_ready(self):
+        return self.in_buffer.read_ready()
+
+    def recv_stderr_ready(self):
+        return self.in_stderr_buffer.read_ready()
+
+    def exit_status_ready(self):
+        return self.status_event.is_set()
+
+    def recv_exit_status(self):
+        self.status_event.wait()
+        return self.exit_status
+
+    def sendall(self, data):
+        with self.send_lock:
+            _send_frame(self.sock, b'i', data)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def shutdown_write(self):
+        with self.send_lock, contextlib.suppress(OSError):    # 与paramiko一致, 已关闭的channel上不报错
+            _send_frame(self.sock, b'E')
+
+    def close(self):
+        """先shutdown, 使阻塞在读取上的线程立即返回(仅close不会唤醒)"""
+        with contextlib.suppress(OSError):
+            self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+
+class AgentClient(ClosingContextManager):
+    """通过本地agent(类似 OpenSSH 的 ControlMaster)复用已认证的 Transport.
+    提供与 SSHClient 相同的 connect()/exec_command()/open_sftp()/close(), 以便 AutoTask 不加区分地使用"""
+    def __init__(self, sock_path):
+        self.sock_path = sock_path
+        self.conn_args = None
+        self.socks = []    # exec/sftp 的unix连接, close()时全部断开
+
+    def _request(self, **req):
+        """每个请求(连接/exec/sftp)都单独连接一次agent, 一个unix连接对应agent上的一个channel"""
+        try:
+            sock = AgentSocket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.sock_path)
+        except OSError as err:
+            sock.close()
+            raise AgentUnavailable(err)
+        req.update(self.conn_args)
+        sock.sendall(json.dumps(req).encode() + b'\n')
+        rfile = sock.makefile('rb')
+        reply = json.loads(rfile.readline() or b'{"ok": false, "error": "agent closed connection"}')
+        if not reply['ok']:
+            sock.close()
+            if reply.get('timeout'):
+                raise socket.timeout(reply['error'])
+            raise SSHException(reply['error'])
+        self.socks.append(sock)
+        return sock, rfile
+
+    def connect(self, hostname, port=22, username=None, password=None, key_filename=None, timeout=None, profile=('default', {})):
+        self.conn_args = {'ip': hostname, 'port': port, 'user': username, 'password': password,
+                          'pkey': key_filename, 'timeout': timeout, 'profile': list(profile)}
+        sock, _ = self._request(kind='connect')
+        self.socks.remove(sock)
+        sock.close()
+
+    def exec_command(self, command):
+        sock, rfile = self._request(kind='exec', command=command)
+        chan = AgentChannel(sock, rfile)
+        return ChannelStdinFile(chan, 'wb'), ChannelFile(chan, 'r'), ChannelStderrFile(chan, 'r')
+
+    def open_sftp(self):
+        sock, _ = self._request(kind='sftp')
+        return SFTPClient(sock)
+
+    def get_transport(self):
+        """Transport 在agent进程中, 本地无法直接访问"""
+        return None
+
+    def close(self):
+        """连接由agent持有, 这里只断开本地的unix连接, agent随之关闭对应的channel"""
+        for sock in self.socks:
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+        self.socks = []
+
+
+class ConnectionAgent:
+    """本地常驻的连接池进程: 以 (user, ip, port, profile) 为键持有已认证的 Transport, 空闲超时后关闭.
+    客户端通过unix socket(权限0600, 只有当前用户可用)请求在这些 Transport 上开启新的 channel, 并由agent中转数据"""
+    def __init__(self, sock_path, idle):
+        self.sock_path = sock_path
+        self.idle = idle
+        self.lock = threading.Lock()
+        self.pool = {}    # key: (user, ip, port, profile) --> [SSHClient, 最后使用时间, 活动channel数, 连接锁]
+
+    def _entry(self, req):
+        key = (req['user'], req['ip'], int(req['port']), req.get('profile', ['default'])[0])
+        with self.lock:
+            entry = self.pool.setdefault(key, [None, 0, 0, threading.Lock()])
+            entry[2] += 1
+        return entry
+
+    def _release(self, entry):
+        with self.lock:
+            entry[1] = time.time()
+            entry[2] -= 1
+
+    def _get_transport(self, entry, req):
+        """同一主机的并发请求只建立一次连接"""
+        with entry[3]:
+            client = entry[0]
+            if client is None or not client.get_transport() or not client.get_transport().is_active():
+                client = SSHClient()
+                client.set_missing_host_key_policy(AutoAddPolicy())
+                profile = req.get('profile', ['default', {}])[1]
+                client.connect(req['ip'], port=int(req['port']), username=req['user'], password=req['password'],
+                               key_filename=req['pkey'], timeout=req['timeout'], **profile_connect_args(profile))
+                tune_transport(client.get_transport(), profile)
+                entry[0] = client
+            return client.get_transport()
+
+    def _evict(self):
+        """后台线程: 定期关闭空闲超时且没有活动channel的连接"""
+        while True:
+            time.sleep(min(self.idle, 30))
+            with self.lock:
+                for key, entry in list(self.pool.items()):
+                    if entry[2] == 0 and time.time() - entry[1] > self.idle:
+                        if entry[0]:
+                            entry[0].close()
+                        del self.pool[key]
+
+    @staticmethod
+    def _relay_raw(conn, chan):
+        """sftp: 在unix连接和channel之间原样转发字节"""
+        while True:
+            r, _, _ = select.select([conn, chan], [], [])
+            if conn in r:
+                data = conn.recv(32768)
+                if not data:
+                    break
+                chan.sendall(data)
+            if chan in r:
+                data = chan.recv(32768)
+                if not data:
+                    break
+                conn.sendall(data)
+
+    @staticmethod
+    def _relay_exec(conn, rfile, chan):
+        """exec: 客户端发来的 stdin 帧由单独线程写入channel; 本线程把 stdout/stderr/退出码 按帧发回客户端"""
+        def feed_stdin():
+            try:
+                while True:
+                    kind, data = _recv_frame(rfile)
+                    if kind == b'i':
+                        chan.sendall(data)
+                    elif kind == b'E':
+                        chan.shutdown_write()
+                    else:
+                        chan.close()    # 客户端断开
+                        break
+            except OSError:
+                chan.close()
+        threading.Thread(target=feed_stdin, daemon=True).start()
+        while True:
+            select.select([chan], [], [], 1)
+            if chan.recv_ready():
+                _send_frame(conn, b'o', chan.recv(32768))
+            elif chan.recv_stderr_ready():
+                _send_frame(conn, b'e', chan.recv_stderr(32768))
+            elif chan.exit_status_ready() or chan.closed:
+                _send_frame(conn, b'x', struct.pack('>i', chan.recv_exit_status()))
+                break
+
+    def handle(self, conn):
+        rfile = conn.makefile('rb')
+        entry = None
+        try:
+            req = json.loads(rfile.readline())
+            entry = self._entry(req)
+            try:
+                transport = self._get_transport(entry, req)
+                if req['kind'] == 'connect':
+                    chan = None
+                else:
+                    chan = transport.open_session()
+                    if req['kind'] == 'sftp':
+                        chan.invoke_subsystem('sftp')
+                    else:
+                        chan.exec_command(req['command'])
+            except (TimeoutError, socket.timeout) as err:
+                conn.sendall(json.dumps({'ok': False, 'timeout': True, 'error': str(err)}).encode() + b'\n')
+                return
+            except Exception as err:
+                conn.sendall(json.dumps({'ok': False, 'error': str(err)}).encode() + b'\n')
+                return
+            conn.sendall(b'{"ok": true}\n')
+            if chan is None:
+                return
+            with chan:
+                if req['kind'] == 'sftp':
+                    self._relay_raw(conn, chan)
+                else:
+                    self._relay_exec(conn, rfile, chan)
+        except (OSError, ValueError):
+            pass
+        finally:
+            if entry:
+                self._release(entry)
+            conn.close()
+
+    def serve(self):
+        if os.path.exists(self.sock_path):
+            os.remove(self.sock_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(self.sock_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(128)
+        threading.Thread(target=self._evict, daemon=True).start()
+        OutputText.print_color('{}----agent listening on {}'.format(INDENT_1, self.sock_path), color=33)
+        try:
+            while True:
+                conn, _ = server.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            server.close()
+            os.remove(self.sock_path)
+
+
 class AutoTask:
     def __init__(self, hostname, ip, port):
         self.hostname = hostname
         self.ip = ip
         self.port = int(port)
+        self.user = host_user(hostname)
+        self.profile = host_profile(hostname)
         self.client = SSHClient()
         self.client.set_missing_host_key_policy(AutoAddPolicy())
-        self.output = OutputText()
+        self.output = OutputText(hostname)
         self.sftp = None
-        self.output.write_or_print('\n{}----{}\n'.format(INDENT_1, hostname), color=33)
+        self.stat_lock = threading.Lock()
+        self.transferred = [0, 0]    # 已传输的 文件数, 字节数
+        self.buckets = host_buckets(hostname, ip)
+        self.journal = None
+        self.stats = HostStats(hostname) if arguments['--stats'] or arguments['--stats-file'] else None
+        # 本主机出错时置位, 只结束本主机的传输/后续步骤; 是否不再开始其他主机由worker决定
+        # (play模式下由 --max-fail 决定, 其他模式出错即不再开始新的主机, 已在执行的主机照常完成)
+        self.event = threading.Event()
+        self.dropped = False
+        self.failed = False    # 远端命令出错(含 --skip-err 时被跳过的错误)
+        if not aggregator:
+            self.output.write_or_print('\n{}----{}\n'.format(INDENT_1, hostname), color=33)
+
+    def _connection(self):
+        """cmd/put/get结束后即关闭连接; play模式下各步骤共用一个连接, 由worker在全部步骤结束后关闭"""
+        return contextlib.nullcontext() if arguments['play'] else self.client
+
+    def abort(self):
+        """--drop-stragglers: 置位本主机的event(传输循环随之结束, worker不会因此停止其他主机),
+        再关闭连接, 使阻塞中的读写立即出错返回"""
+        self.dropped = True
+        self.event.set()
+        self.client.close()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _deadline(chan, seconds):
+        """--timeout: 超时后关闭channel, 阻塞中的读取随即返回; yield的列表在超时后非空"""
+        expired = []
+        if not seconds:
+            yield expired
+            return
+
+        def kill():
+            expired.append(seconds)
+            with contextlib.suppress(EOFError, OSError, SSHException):    # 连接可能已经断开
+                chan.close()
+        timer = threading.Timer(float(seconds), kill)
+        timer.daemon = True
+        timer.start()
+        try:
+            yield expired
+        finally:
+            timer.cancel()
+
+    def open_sftp(self):
+        sftp = self.client.open_sftp()
+        return CountedSFTP(sftp, self.stats) if self.stats else sftp
+
+    def _timed_connect(self, conn_args):
+        """--stats: 分别记录 TCP连接, 密钥交换, 认证 的耗时(认证通过替换 SSHClient._auth 计时)"""
+        start = time.time()
+        conn_args['sock'] = socket.create_connection((self.ip, self.port), timeout=conn_args['timeout'])
+        self.stats.add('tcp', time.time() - start)
+        auth = self.client._auth
+        auth_time = [0]    # 本次连接的认证耗时; 重试时每次连接单独计算
 
+        def timed_auth(*args, **kwargs):
+            auth_start = time.time()
+            try:
+                return auth(*args, **kwargs)
+            finally:
+                auth_time[0] += time.time() - auth_start
+        self.client._auth = timed_auth
+        start = time.time()
+        try:
+            self.client.connect(self.ip, **conn_args)
+        finally:
+            del self.client._auth    # 恢复为类上的方法, 重试时不会重复包装
+            self.stats.add('auth', auth_time[0])
+            self.stats.add('kex', time.time() - start - auth_time[0])
+
+    @timed('connect')
     def create_sshclient(self):
         """根据命令行提供的参数,建立到远程server的ssh链接.这段本应在run_command()函数内部。
         摘出来的目的是为了让sftp功能也通过sshclient对象来创建sftp对象,因为初步观察t.connect()方法在使用key时有问题"""
+        retries = int(arguments['--retries'])
+        for attempt in range(retries + 1):
+            ret, err = self._connect_once()
+            transient = isinstance(err, (OSError, EOFError)) or (isinstance(err, SSHException) and 'banner' in str(err))
+            if err is None or not transient or isinstance(err, AuthenticationException) or attempt == retries or event.is_set():
+                break
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            self.output.write_or_print('{}SSH connect error: {}, retry {}/{} in {:.1f}s\n'.format(INDENT_2, err, attempt + 1, retries, delay), color=33)
+            self.client.close()
+            event.wait(delay)    # Ctrl+C 或其他主机出错时不再等待
+        if err is not None:
+            self.output.write_or_print('{}SSH connect error: {}\n'.format(INDENT_2, err), color=31)
+            self.output.print_lock()
+        return ret
+
+    def _connect_once(self):
+        """连接一次, 返回 (create_sshclient()的返回值, 异常)"""
+        conn_args = connect_args(self.hostname, self.port)
         try:
+            if hasattr(socket, 'AF_UNIX') and os.path.exists(arguments['--agent-sock']):
+                # agent在运行时, 复用其持有的已认证连接; agent已退出则回退为直连
+                agent_client = AgentClient(arguments['--agent-sock'])
+                try:
+                    agent_client.connect(self.ip, profile=self.profile, **conn_args)
+                    self.client = agent_client
+                    return True, None
+                except AgentUnavailable:
+                    pass
             # client.connect()方法会调用Transport类额外创建一个daemon线程
-            self.client.connect(self.ip, port=self.port, username=arguments['-u'], password=arguments['-p'], key_filename=arguments['--pkey'], timeout=10)
-            return True
+            conn_args = connect_args(self.hostname, self.port, self.profile[1])
+            if self.stats:
+                self._timed_connect(conn_args)
+            else:
+                self.client.connect(self.ip, **conn_args)
+            tune_transport(self.client.get_transport(), self.profile[1])
+            return True, None
         except (TimeoutError, socket.timeout) as err:
-            self.output.write_or_print('{}SSH connect error: {}\n'.format(INDENT_2, err), color=31)
-            self.output.print_lock()
-            return 'continue'
-        except Exception as err:  # 有异常,打印异常,并返回'error'
-            self.output.write_or_print('{}SSH connect error: {}\n'.format(INDENT_2, err), color=31)
-            self.output.print_lock()
-            return False
+            return 'continue', err
+        except Exception as err:  # 有异常,返回'error'
+            return False, err
 
-    def run_command(self, cmd):
+    @timed('exec')
+    def run_command(self, cmd, skip_err=None, timeout=None):
         """
         执行远程命令的主函数
         client: paramiko.client.SSHClient object
         cmd: 待执行的命令
+        skip_err: play中单个步骤的设置, 默认为 --skip-err
+        timeout: play中单个步骤的设置, 默认为 --timeout
         """
+        skip_err = arguments['--skip-err'] if skip_err is None else skip_err
+        timeout = arguments['--timeout'] if timeout is None else timeout
+        if arguments['--stream'] or arguments['--output-dir']:
+            return self._stream_command(cmd, skip_err, timeout)
         # stdout 假如通过分号提供单行的多条命令,所有命令的输出（在linux终端会输出的内容）都会存储于stdout
         # 据观察,下面三个变量的特点是无论"如何引用过一次"之后,其内容就会清空
         # 有readlines()的地方都是流,用过之后就没有了
-        with self.client:
+        with self._connection():
             _, stdout_, stderr_ = self.client.exec_command(cmd)
-            copy_out, copy_err = stdout_.readlines(), stderr_.readlines()
+            with self._deadline(stdout_.channel, timeout) as expired:
+                copy_out, copy_err = stdout_.readlines(), stderr_.readlines()
+            if expired:
+                copy_err.append('timeout: channel closed after {}s\n'.format(timeout))
+            elif self.dropped:
+                copy_err.append('dropped as a straggler, connection closed\n')
             copy_out_ = ('%s%s' % (INDENT_3, i) for i in copy_out)
             copy_err_ = ('%s%s' % (INDENT_3, i) for i in copy_err)
             del stdout_, stderr_
@@ -151,11 +1327,80 @@ class AutoTask:
                 self.output.write_or_print('%s----error:\n' % INDENT_2, color=31)
                 self.output.write_or_print(*copy_err_, color=31)
                 self.output.print_lock()
-                if not arguments['--skip-err']:
-                    event.set()
             else:  # 既无stdout也无stderr,例如nginx -s reload
                 self.output.write_or_print('%s----result:\n' % INDENT_2)
                 self.output.print_lock()
+            if expired or (copy_err and not copy_out):
+                self.failed = True
+                if not skip_err:
+                    self.event.set()
+
+    def _emit_lines(self, data, pending, color=None, file_=None):
+        """流式模式: 只缓存最后一个不完整的行, 完整的行立即输出(或写入文件), 内存占用与输出总量无关"""
+        if file_:
+            file_.write(data)
+        if not arguments['--stream']:
+            return
+        lines = (pending.pop() + data).split(b'\n')
+        pending.append(lines.pop())
+        if len(pending[0]) > STREAM_LINE_MAX:    # 超长且没有换行的内容也按行输出, 避免无限缓存
+            lines.append(pending.pop())
+            pending.append(b'')
+        if lines:
+            with global_lock:
+                for line in lines:
+                    line = '[{}] {}'.format(self.hostname, line.decode('utf-8', 'replace'))
+                    if color:
+                        OutputText.print_color(line, color=color, flush=True)
+                    else:
+                        print(line, flush=True)
+
+    def _stream_command(self, cmd, skip_err, timeout):
+        """通过 recv_ready()/recv_stderr_ready() 增量读取两个通道, 不等待命令结束, 也不缓存完整输出"""
+        out_file = err_file = None
+        if arguments['--output-dir']:
+            mode = 'ab' if arguments['play'] else 'wb'    # play的各个步骤追加到同一个文件, 文件在 run_play() 开始时清空
+            out_file = open(os.path.join(arguments['--output-dir'], self.hostname + '.out'), mode)
+            err_file = open(os.path.join(arguments['--output-dir'], self.hostname + '.err'), mode)
+        has_out = has_err = False
+        out_pending, err_pending = [b''], [b'']
+        with self._connection():
+            _, stdout_, _ = self.client.exec_command(cmd)
+            chan = stdout_.channel
+            with self._deadline(chan, timeout) as expired:
+                while True:
+                    if chan.recv_ready():
+                        self._emit_lines(chan.recv(32768), out_pending, file_=out_file)
+                        has_out = True
+                    elif chan.recv_stderr_ready():
+                        self._emit_lines(chan.recv_stderr(32768), err_pending, color=31, file_=err_file)
+                        has_err = True
+                    elif chan.exit_status_ready():
+                        break
+                    else:
+                        chan.status_event.wait(0.05)
+            status = chan.recv_exit_status()
+        # 输出末尾没有换行的残余内容
+        if out_pending[0]:
+            self._emit_lines(b'\n', out_pending)
+        if err_pending[0]:
+            self._emit_lines(b'\n', err_pending, color=31)
+        for file_ in (out_file, err_file):
+            if file_:
+                file_.close()
+        if arguments['--output-dir']:
+            self.output.write_or_print('%s----saved: %s.out %s.err\n' % (INDENT_2, *[os.path.join(arguments['--output-dir'], self.hostname)] * 2))
+        if expired:
+            self.output.write_or_print('%s----timeout: channel closed after %ss\n' % (INDENT_2, timeout), color=31)
+        elif self.dropped:
+            self.output.write_or_print('%s----dropped as a straggler, connection closed\n' % INDENT_2, color=31)
+        else:
+            self.output.write_or_print('%s----exit status: %s\n' % (INDENT_2, status), color=31 if status else None)
+        self.output.print_lock()
+        if expired or has_err and not has_out:
+            self.failed = True
+            if not skip_err:
+                self.event.set()
 
     # 先定义sftp_transfer()函数所需的一些子函数
     @staticmethod
@@ -166,40 +1411,234 @@ class AutoTask:
         else:
             return target
 
-    def _sftp_put(self, src, dst, if_raise=False):
-        """封装put,增加相应输出,并依据m_time和size判断两端文件一致性,决定是否传输该文件"""
+    def _count_transferred(self, size):
+        with self.stat_lock:
+            self.transferred[0] += 1
+            self.transferred[1] += size
+
+    def _report_transferred(self, start, before=(0, 0)):
+        """before: 本次传输开始前的计数(play模式下同一主机有多个传输步骤)"""
+        files, size = self.transferred[0] - before[0], self.transferred[1] - before[1]
+        elapsed = max(time.time() - start, 0.001)
+        limits = ' (bwlimit: {})'.format(', '.join('{} {}/s'.format(name, human_size(bucket.rate)) for name, bucket in self.buckets)) if self.buckets else ''
+        self.output.write_or_print('%s----%s files, %s in %.2fs, %s/s%s\n' % (INDENT_2, files, human_size(size), elapsed, human_size(size / elapsed), limits))
+
+    def _throttle(self, size):
+        """按传输的字节数消耗所受约束的各令牌桶, 超速时在此睡眠到最慢的桶还清欠账;
+        睡眠中 event 被设置(出错, Ctrl+C, 被作为掉队者中止)时立即返回"""
+        if not self.buckets:
+            return
+        deadline = time.monotonic() + max(bucket.consume(size) for _, bucket in self.buckets)
+        while not self.event.is_set() and time.monotonic() < deadline:
+            time.sleep(min(0.1, deadline - time.monotonic()))
+
+    def _throttle_callback(self):
+        """sftp.put()/get()的callback: 每传输一块(32KB)按增量限速; 不限速时为None"""
+        if not self.buckets:
+            return None
+        done = [0]
+
+        def callback(transferred, total):
+            self._throttle(transferred - done[0])
+            done[0] = transferred
+        return callback
+
+    @staticmethod
+    def _changed(src_stat, dst_stat):
+        """依据m_time和size判断两端文件是否一致(sftp的时间只精确到秒)"""
+        return isinstance(dst_stat, str) or not (int(src_stat.st_mtime) == int(dst_stat.st_mtime) and src_stat.st_size == dst_stat.st_size)
+
+    @staticmethod
+    def _delta_applicable(src_stat, dst_stat):
+        """目标端已有足够大的普通文件时, 才值得差异传输"""
+        return (arguments['--delta'] and not isinstance(dst_stat, str) and stat.S_ISREG(dst_stat.st_mode)
+                and min(src_stat.st_size, dst_stat.st_size) >= DELTA_MIN_SIZE)
+
+    def _delta_put(self, src, dst, src_stat, dst_stat):
+        """差异上传: 远端对已有文件计算块签名, 本地据此生成差异流, 远端重建到临时文件后原子改名.
+        返回发送的字面数据字节数; 远端无法执行辅助程序或文件改变过多时返回None, 由调用方完整传输"""
+        block_size = delta_block_size(dst_stat.st_size)
+        _, stdout_, _ = self.client.exec_command(delta_helper_command('sign', dst, block_size))
+        signature = stdout_.read()
+        if stdout_.channel.recv_exit_status() != 0:
+            return None
+        stdin_, stdout_, _ = self.client.exec_command(delta_helper_command(
+            'patch', dst, block_size, stat.S_IMODE(src_stat.st_mode), src_stat.st_atime, src_stat.st_mtime))
+        try:
+            with open(src, 'rb') as f:
+                literal = delta_make(f, signature, block_size, stdin_, src_stat.st_size // 2, delta_min_scan(src_stat.st_size))
+            stdin_.close()
+        except DeltaAborted:
+            stdin_.channel.close()    # 差异流没有结束标记, 远端会删除临时文件
+            return None
+        if stdout_.channel.recv_exit_status() != 0:
+            return None
+        return literal
+
+    def _delta_get(self, src, dst, src_stat, dst_stat):
+        """差异下载: 本地对已有文件计算块签名发给远端, 远端生成差异流, 本地重建到临时文件后原子改名.
+        返回收到的字面数据字节数; 无法差异传输时返回None"""
+        block_size = delta_block_size(dst_stat.st_size)
+        signature = io.BytesIO()
+        with open(dst, 'rb') as f:
+            delta_sign(f, block_size, signature)
+        stdin_, stdout_, _ = self.client.exec_command(delta_helper_command('delta', src, block_size, src_stat.st_size // 2, delta_min_scan(src_stat.st_size)))
+        stdin_.write(signature.getvalue())
+        stdin_.close()
+        tmp = os.path.join(os.path.dirname(dst), '.%s.auto_task.delta' % os.path.basename(dst))
+        with open(dst, 'rb') as basis, open(tmp, 'wb') as out:
+            literal = delta_patch(basis, stdout_, out, block_size)
+        if literal is None or stdout_.channel.recv_exit_status() != 0:
+            os.remove(tmp)
+            return None
+        os.utime(tmp, (src_stat.st_atime, src_stat.st_mtime))
+        os.chmod(tmp, src_stat.st_mode)
+        os.replace(tmp, dst)
+        return literal
+
+    @staticmethod
+    def _part_path(path):
+        """续传使用的临时文件, 与目标在同一目录下, 完成后原子改名"""
+        return os.path.join(os.path.dirname(path), '.%s.auto_task.part' % os.path.basename(path)).replace('\\', '/')
+
+    def _verified_offset(self, local_path, remote_path, count):
+        """比较两端文件开头 count 个块的md5, 返回第一个不一致的块的偏移量; 远端无法执行辅助程序时返回0(从头传输)"""
+        if count <= 0:
+            return 0
+        _, stdout_, _ = self.client.exec_command(delta_helper_command('hashes', remote_path, RESUME_CHUNK, count))
+        remote = stdout_.read().decode().split()
+        if stdout_.channel.recv_exit_status() != 0:
+            return 0
+        with open(local_path, 'rb') as f:
+            local = chunk_hashes(f, RESUME_CHUNK, count)
+        verified = 0
+        for local_hash, remote_hash in zip(local, remote):
+            if local_hash != remote_hash:
+                break
+            verified += 1
+        return verified * RESUME_CHUNK
+
+    def _resume_put(self, src, dst, src_stat, sftp):
+        """大文件上传: 分块写入远端临时文件, 已有临时文件时从校验一致的位置续传, 完成后设置属性并原子改名.
+        中途出错或 event 被设置时保留临时文件, 供下次续传. 返回续传的起始偏移量"""
+        part = self._part_path(dst)
+        try:
+            part_size = sftp.stat(part).st_size
+        except FileNotFoundError:
+            part_size = 0
+        offset = self._verified_offset(src, part, min(part_size, src_stat.st_size) // RESUME_CHUNK)
+        with open(src, 'rb') as f, sftp.open(part, 'r+' if offset else 'w') as out:
+            if offset:
+                out.truncate(offset)
+                out.seek(offset)
+                f.seek(offset)
+            out.set_pipelined(True)
+            for data in iter(lambda: f.read(RESUME_CHUNK), b''):
+                if self.event.is_set():
+                    raise InterruptedError('stopped, {} will resume next time'.format(part))
+                self._throttle(len(data))
+                out.write(data)
+        sftp.utime(part, (src_stat.st_atime, src_stat.st_mtime))
+        sftp.chmod(part, src_stat.st_mode)
+        sftp.posix_rename(part, dst)
+        return offset
+
+    def _resume_get(self, src, dst, src_stat, sftp):
+        """大文件下载: 与 _resume_put() 相同, 临时文件在本地"""
+        part = self._part_path(dst)
+        part_size = os.path.getsize(part) if os.path.isfile(part) else 0
+        offset = self._verified_offset(part, src, min(part_size, src_stat.st_size) // RESUME_CHUNK)
+        with sftp.open(src, 'rb') as f, open(part, 'r+b' if offset else 'wb') as out:
+            if offset:
+                out.truncate(offset)
+                out.seek(offset)
+                f.seek(offset)
+            f.prefetch(src_stat.st_size)
+            for data in iter(lambda: f.read(RESUME_CHUNK), b''):
+                if self.event.is_set():
+                    raise InterruptedError('stopped, {} will resume next time'.format(part))
+                self._throttle(len(data))
+                out.write(data)
+        os.utime(part, (src_stat.st_atime, src_stat.st_mtime))
+        os.chmod(part, src_stat.st_mode)
+        os.replace(part, dst)
+        return offset
+
+    def _open_journal(self, root):
+        """journal以 (ip:port, 目标根目录) 为键"""
+        if arguments['--journal']:
+            return SyncJournal(arguments['--journal'], '{}:{}'.format(self.ip, self.port), root)
+
+    def _save_journal(self):
+        """传输过程中出错时不会执行到这里, 未保存的记录只会使下次多检查一些文件"""
+        if self.journal and not self.event.is_set():
+            self.journal.save()
+
+    def _sftp_put(self, src, dst, if_raise=False, dst_stat=None, sftp=None):
+        """封装put,增加相应输出,并依据m_time和size判断两端文件一致性,决定是否传输该文件
+        dst_stat: 调用方已从目录清单中得到的远端属性(不存在为'no_exist'), 提供时不再单独stat远端
+        sftp: TransferPool中各线程自己的sftp对象, 默认为self.sftp"""
+        sftp = sftp or self.sftp
         src_stat = self._path_stat(src, 'local')
-        dst_stat = self._path_stat(dst, 'remote')    # 一次远非核心程调用
-        if isinstance(dst_stat, str) or not (int(src_stat.st_mtime) == dst_stat.st_mtime and src_stat.st_size == dst_stat.st_size):
+        if dst_stat is None:
+            dst_stat = self._path_stat(dst, 'remote')    # 一次远非核心程调用
+        if self._changed(src_stat, dst_stat):
             try:
-                self.sftp.put(src, dst)
-                self.sftp.utime(dst, (src_stat.st_atime, src_stat.st_mtime))    # 一次远非核心程调用
-                self.sftp.chmod(dst, src_stat.st_mode)  # 一次远非核心程调用
-                self.output.write_or_print('%s%s\n' % (INDENT_3, src))
+                sent = self._delta_put(src, dst, src_stat, dst_stat) if self._delta_applicable(src_stat, dst_stat) else None
+                if sent is not None:
+                    self.output.write_or_print('%s%s (delta: %s of %s)\n' % (INDENT_3, src, human_size(sent), human_size(src_stat.st_size)))
+                elif src_stat.st_size >= RESUME_MIN_SIZE:
+                    offset = self._resume_put(src, dst, src_stat, sftp)
+                    sent = src_stat.st_size - offset
+                    self.output.write_or_print('%s%s (resumed at %s)\n' % (INDENT_3, src, human_size(offset)) if offset else '%s%s\n' % (INDENT_3, src))
+                else:
+                    sftp.put(src, dst, callback=self._throttle_callback())
+                    sftp.utime(dst, (src_stat.st_atime, src_stat.st_mtime))    # 一次远非核心程调用
+                    sftp.chmod(dst, src_stat.st_mode)  # 一次远非核心程调用
+                    self.output.write_or_print('%s%s\n' % (INDENT_3, src))
+                    sent = src_stat.st_size
+                self._count_transferred(sent)
             except Exception as e:
                 if not if_raise:
                     self.output.write_or_print('{}sftp.put({}, {}): {}\n'.format(INDENT_3, src, dst, e), color=31)
                     self.output.print_lock()
-                    event.set()
+                    self.event.set()
                     exit()
                 else:
                     raise
+        if self.journal:
+            self.journal.record(dst, src_stat)
 
-    def _sftp_get(self, src, dst, if_raise=False):
-        """封装get,增加相应输出,并依据m_time和size判断两端文件一致性,决定是否传输该文件"""
-        src_stat = self._path_stat(src, 'remote')    # 一次远非核心程调用
-        dst_stat = self._path_stat(dst, 'local')
-        if isinstance(dst_stat, str) or not (src_stat.st_mtime == int(dst_stat.st_mtime) and src_stat.st_size == dst_stat.st_size):
+    def _sftp_get(self, src, dst, if_raise=False, src_stat=None, dst_stat=None, sftp=None):
+        """封装get,增加相应输出,并依据m_time和size判断两端文件一致性,决定是否传输该文件
+        src_stat/dst_stat: 调用方已从目录清单中得到的两端属性, 提供时不再单独stat
+        sftp: TransferPool中各线程自己的sftp对象, 默认为self.sftp"""
+        sftp = sftp or self.sftp
+        if src_stat is None:
+            src_stat = self._path_stat(src, 'remote')    # 一次远非核心程调用
+        if dst_stat is None:
+            dst_stat = self._path_stat(dst, 'local')
+        if self._changed(src_stat, dst_stat):
             try:
-                self.sftp.get(src, dst)
-                os.utime(dst, (src_stat.st_atime, src_stat.st_mtime))
-                os.chmod(dst, src_stat.st_mode)
-                self.output.write_or_print('%s%s\n' % (INDENT_3, src))
+                sent = self._delta_get(src, dst, src_stat, dst_stat) if self._delta_applicable(src_stat, dst_stat) else None
+                if sent is not None:
+                    self.output.write_or_print('%s%s (delta: %s of %s)\n' % (INDENT_3, src, human_size(sent), human_size(src_stat.st_size)))
+                elif src_stat.st_size >= RESUME_MIN_SIZE:
+                    offset = self._resume_get(src, dst, src_stat, sftp)
+                    sent = src_stat.st_size - offset
+                    self.output.write_or_print('%s%s (resumed at %s)\n' % (INDENT_3, src, human_size(offset)) if offset else '%s%s\n' % (INDENT_3, src))
+                else:
+                    sftp.get(src, dst, callback=self._throttle_callback())
+                    os.utime(dst, (src_stat.st_atime, src_stat.st_mtime))
+                    os.chmod(dst, src_stat.st_mode)
+                    self.output.write_or_print('%s%s\n' % (INDENT_3, src))
+                    sent = src_stat.st_size
+                self._count_transferred(sent)
             except Exception as err:
                 if not if_raise:
                     self.output.write_or_print('{}sftp.get({}, {}): {}\n'.format(INDENT_3, src, dst, err), color=31)
                     self.output.print_lock()
-                    event.set()
+                    self.event.set()
                     exit()
                 else:
                     raise
@@ -237,8 +1676,27 @@ class AutoTask:
             except Exception:
                 raise
 
-    def _makedirs_local(self, dirname, r_path):
-        """在本地递归创建目录. 基本参照os.makedirs(), 增加了对时间和权限的同步功能"""
+    def _listdir_remote(self, path_):
+        """一次 listdir_attr() 取得远端目录下所有条目的属性, 返回 {name: SFTPAttributes}; 目录不存在时返回None.
+        listdir_attr 不跟随符号链接, 只对链接再单独stat一次"""
+        try:
+            attrs = self.sftp.listdir_attr(path_)    # 一次远非核心程调用
+        except FileNotFoundError:
+            return None
+        manifest = {}
+        for attr in attrs:
+            name = attr.filename    # stat()返回的属性没有filename
+            if stat.S_ISLNK(attr.st_mode):
+                try:
+                    attr = self.sftp.stat(os.path.join(path_, name).replace('\\', '/'))    # 一次远非核心程调用
+                except FileNotFoundError:
+                    continue
+            manifest[name] = attr
+        return manifest
+
+    def _makedirs_local(self, dirname, r_path, r_stat=None):
+        """在本地递归创建目录. 基本参照os.makedirs(), 增加了对时间和权限的同步功能
+        r_stat: 调用方已知的远端目录属性, 提供时不再单独stat远端"""
         if os.path.isdir(dirname):
             return
         l_head, l_tail = os.path.split(dirname)
@@ -255,14 +1713,20 @@ class AutoTask:
                 # Defeats race condition when another thread created the path
                 pass
         try:
-            os.mkdir(dirname)
-            remote_stat = self._path_stat(r_path, 'remote')    # 一次远非核心程调用
+            try:
+                os.mkdir(dirname)
+            except FileExistsError:
+                # 并行下载时, 各主机共同的上级目录可能已被其他线程创建
+                if os.path.isdir(dirname):
+                    return
+                raise
+            remote_stat = r_stat or self._path_stat(r_path, 'remote')    # 一次远非核心程调用
             os.utime(dirname, (remote_stat.st_atime, remote_stat.st_mtime))
             os.chmod(dirname, remote_stat.st_mode)
         except Exception as e:
             self.output.write_or_print('{}Error: os.mkdir({}): {}\n'.format(INDENT_3, dirname, e), color=31)
             self.output.print_lock()
-            event.set()
+            self.event.set()
             exit()
 
     def _makedirs_remote(self, dirname, l_path):
@@ -280,6 +1744,10 @@ class AutoTask:
                 self._makedirs_remote(r_head, l_head)
             except FileExistsError:
                 pass
+        self._mkdir_remote(dirname, l_path)
+
+    def _mkdir_remote(self, dirname, l_path):
+        """父目录确定存在时, 直接创建远端目录并同步时间和权限"""
         try:
             self.sftp.mkdir(dirname)
             local_stat = self._path_stat(l_path, 'local')
@@ -288,41 +1756,244 @@ class AutoTask:
         except Exception as e:
             self.output.write_or_print('{}Error: sftp.mkdir({}): {}\n'.format(INDENT_3, dirname, e), color=31)
             self.output.print_lock()
-            event.set()
+            self.event.set()
             exit()
 
-    def _put_dirs(self, src_dir, dst_dir):
-        """put目录时: 通过一次os.walk(), 先循环将所有的源端目录和目标端目录的结构同步好; 再循环上传所有文件"""
+    def _journal_clean(self, root, d_root, dirs, files):
+        """依据journal判断本地目录自上次put后是否没有变化: 目录本身和子目录都已记录, 所有文件的大小和mtime都与记录一致"""
+        if not self.journal.has_dir(d_root) or not all(self.journal.has_dir(os.path.join(d_root, dir_)) for dir_ in dirs):
+            return False
+        return all(self.journal.unchanged(os.path.join(d_root, file_), os.stat(os.path.join(root, file_))) for file_ in files)
+
+    def _put_plan(self, src_dir, dst_dir):
+        """put目录时: 通过一次os.walk()逐个处理源端目录. 每个目录只用一次 listdir_attr() 取得远端对应目录的清单,
+        在内存中与本地比对, 依次产生需要的操作, 由调用方执行:
+        ('root', 源目录, 目标目录) 远端根目录不存在; ('dir', 源目录, 目标目录) 远端子目录不存在;
+        ('file', 源文件, 目标文件, 目标文件属性或'no_exist')
+        --trust-journal 时, journal中记录未变化的目录完全跳过(按 --verify 比例抽查)"""
+        new_dirs = set()    # 本次新建的远端目录, 其内容必然为空, 无需再列目录
+        trust = self.journal and arguments['--trust-journal']
         for root, dirs, files in os.walk(src_dir):
+            if self.event.is_set():
+                break
+            root = root.replace('\\', '/')
+            d_root = root.replace(src_dir, dst_dir, 1)
+            if trust and self._journal_clean(root, d_root, dirs, files) and random.random() >= float(arguments['--verify']):
+                continue
+            remote = {} if d_root in new_dirs else self._listdir_remote(d_root)
+            if remote is None:
+                yield 'root', root, d_root
+                remote = {}
+            if self.journal:
+                self.journal.record_dir(d_root)
             for dir_ in dirs:
                 s_dir = os.path.join(root, dir_).replace('\\', '/')
                 d_dir = s_dir.replace(src_dir, dst_dir, 1)
-                self._makedirs_remote(d_dir, s_dir)
+                if dir_ not in remote:
+                    yield 'dir', s_dir, d_dir
+                    new_dirs.add(d_dir)
+                elif not stat.S_ISDIR(remote[dir_].st_mode):
+                    self.output.write_or_print("{}Error: remote {} is file\n".format(INDENT_3, d_dir), color=31)
+                    self.output.print_lock()
+                    self.event.set()
+                    exit()
             for file_ in files:
                 s_file = os.path.join(root, file_).replace('\\', '/')  # 逐级取得每个源端文件的全路径
                 d_file = s_file.replace(src_dir, dst_dir, 1)  # 取得每个目标端文件的全路径
-                self._sftp_put(s_file, d_file)
+                yield 'file', s_file, d_file, remote.get(file_, 'no_exist')
+
+    def _put_dirs(self, src_dir, dst_dir, pool):
+        """逐个sftp调用的put目录: 目录在本线程中按顺序创建, 文件交由 TransferPool 并发传输"""
+        for kind, s_path, d_path, *dst_stat in self._put_plan(src_dir, dst_dir):
+            if kind == 'root':
+                self._makedirs_remote(d_path, s_path)
+            elif kind == 'dir':
+                self._mkdir_remote(d_path, s_path)
+            else:
+                pool.submit(self._sftp_put, s_path, d_path, dst_stat=dst_stat[0])
+
+    def _relay_put(self, parent, dst_dir, names):
+        """由父节点把 dst_dir 下的 names 打包成tar流, 经父节点上的ssh直接传给本server解包, 数据不经过本地.
+        父节点上的ssh通过agent转发使用本地ssh-agent中的密钥(或父节点自己被信任的密钥). 返回是否成功"""
+        remote_cmd = 'mkdir -p {0} && tar -xpzf - --no-same-owner -C {0}'.format(shlex.quote(dst_dir))
+        cmd = 'tar -czf - -C {} --no-recursion --null -T - | ssh -o BatchMode=yes -o StrictHostKeyChecking=no -o LogLevel=ERROR -p {} {}@{} {}'.format(
+            shlex.quote(dst_dir), self.port, shlex.quote(self.user), self.ip, shlex.quote(remote_cmd))
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        try:
+            with client:
+                profile = host_profile(parent[0])[1]
+                client.connect(parent[1], **connect_args(parent[0], parent[2], profile))
+                tune_transport(client.get_transport(), profile)
+                chan = client.get_transport().open_session()
+                handler = AgentRequestHandler(chan) if os.environ.get('SSH_AUTH_SOCK') else None
+                chan.exec_command(cmd)
+                chan.sendall(b'\0'.join(name.encode() for name in names) + b'\0')
+                chan.shutdown_write()
+                status = chan.recv_exit_status()
+                err = chan.makefile_stderr('rb').read().decode('utf-8', 'replace').strip()
+                if handler:
+                    handler.close()
+        except Exception as e:
+            status, err = -1, str(e)
+        if status != 0:
+            self.output.write_or_print('{}relay from {} failed, upload from local: {}\n'.format(INDENT_3, parent[0], err), color=31)
+        return status == 0
 
-    def _get_dirs(self, src_dir, ori_src, ori_dst):
+    def _relay_put_dirs(self, parent, src_dir, dst_dir):
+        """由 _put_plan() 对比本地与本server选出需要的文件(只有元数据经过本地), 再由父节点转发这些文件"""
+        names, files = [], []
+        for kind, s_path, d_path, *dst_stat in self._put_plan(src_dir, dst_dir):
+            if kind == 'file':
+                src_stat = os.stat(s_path)
+                if not self._changed(src_stat, dst_stat[0]):
+                    continue
+                files.append((s_path, d_path, src_stat))
+            if kind != 'root':
+                names.append(d_path[len(dst_dir):])
+        if names and not self._relay_put(parent, dst_dir, names):
+            return False
+        self.output.write_or_print('%s----relayed from %s\n' % (INDENT_2, parent[0]))
+        for s_path, d_path, src_stat in files:
+            self._count_transferred(src_stat.st_size)
+            self.output.write_or_print('%s%s\n' % (INDENT_3, s_path))
+            if self.journal:
+                self.journal.record(d_path, src_stat)
+        return True
+
+    def _relay_put_file(self, parent, src, dst):
+        """单个文件(如一个大的tar包): 本server上的文件与本地不一致时, 由父节点转发其已收到的同一路径的文件"""
+        src_stat = os.stat(src)
+        if self._changed(src_stat, self._path_stat(dst, 'remote')):
+            if not self._relay_put(parent, os.path.dirname(dst), [os.path.basename(dst)]):
+                return False
+            self.output.write_or_print('%s----relayed from %s\n' % (INDENT_2, parent[0]))
+            self.output.write_or_print('%s%s\n' % (INDENT_3, src))
+            self._count_transferred(src_stat.st_size)
+        if self.journal:
+            self.journal.record(dst, src_stat)
+        return True
+
+    def _exec_check(self, stdout_, stderr_, cmd):
+        """等待远程命令结束, 失败时输出错误并退出"""
+        status = stdout_.channel.recv_exit_status()
+        if status != 0:
+            err = stderr_.read().decode('utf-8', 'replace').strip()
+            self.output.write_or_print('{}Error: {} exit {}: {}\n'.format(INDENT_3, cmd, status, err), color=31)
+            self.output.print_lock()
+            self.event.set()
+            exit()
+
+    def _tar_put_dirs(self, src_dir, dst_dir):
+        """--tar 模式put目录: 仍由 _put_plan() 决定传输哪些文件, 但不再逐个sftp调用,
+        而是即时生成只包含这些文件(及缺少的目录)的gzip压缩tar流, 通过一个exec channel输送给远端的 tar x, 由其保留权限和mtime"""
+        items = []
+        for kind, s_path, d_path, *dst_stat in self._put_plan(src_dir, dst_dir):
+            if kind == 'file':
+                src_stat = os.stat(s_path)
+                if not self._changed(src_stat, dst_stat[0]):
+                    if self.journal:
+                        self.journal.record(d_path, src_stat)
+                    continue
+            items.append((kind, s_path, d_path))
+        if not items or self.event.is_set():
+            return
+        cmd = 'mkdir -p {0} && tar -xpzf - --no-same-owner -C {0}'.format(shlex.quote(dst_dir))
+        stdin_, stdout_, stderr_ = self.client.exec_command(cmd)
+        with tarfile.open(fileobj=stdin_, mode='w|gz') as tar:
+            for kind, s_path, d_path in items:
+                if kind == 'root':
+                    continue
+                tar.add(s_path, arcname=d_path[len(dst_dir):], recursive=False)
+                if kind == 'file':
+                    src_stat = os.stat(s_path)
+                    self._count_transferred(src_stat.st_size)
+                    self.output.write_or_print('%s%s\n' % (INDENT_3, s_path))
+                    if self.journal:
+                        self.journal.record(d_path, src_stat)
+            tar.members.clear()    # TarInfo与TarFile互相引用; 打破循环, 使channel文件对象随函数返回正常释放, 而不是由gc在其缓冲被回收后再flush
+        stdin_.close()
+        self._exec_check(stdout_, stderr_, 'tar -x')
+
+    def _get_plan(self, src_dir, ori_src, ori_dst, src_stat=None):
         """
-        get目录时: 通过sftp.listdir()处理远端的目录,并在client端创建不存在的目录,然后文件执行get操作,目录则递归处理.
+        get目录时: 通过sftp.listdir_attr()处理远端的目录, 与本地清单在内存中比对, 目录则递归处理. 依次产生需要的操作, 由调用方执行:
+        ('dir', 源目录, 目标目录, 源目录属性) 本地目录不存在; ('file', 源文件, 目标文件, 源文件属性, 目标文件stat或'no_exist')
         ori_src: 从命令行获取的 源路径
         ori_dst: 从命令行获取的 目标路径
         src_dir: 当前处理到的源端目录, 第一次的引用值与ori_src相同
+        src_stat: 上一级清单中已得到的 src_dir 属性
         """
+        if self.event.is_set():
+            return
         dst_dir = src_dir.replace(ori_src, ori_dst, 1)
-        if not os.path.exists(dst_dir):
-            self._makedirs_local(dst_dir, src_dir)
-        for name in self.sftp.listdir(src_dir):    # 一次远非核心程调用
+        if os.path.exists(dst_dir):
+            local = {entry.name: entry for entry in os.scandir(dst_dir)}
+        else:
+            yield 'dir', src_dir, dst_dir, src_stat
+            local = {}
+        # 一次 listdir_attr() 取得远端目录清单(含属性), 与本地清单在内存中比对
+        for name, attr in self._listdir_remote(src_dir).items():    # 一次远非核心程调用
             s_path = os.path.join(src_dir, name).replace('\\', '/')    # 在win平台下运行的话需要将'\\'替换为'/'，否则s_path在远端不存在
             d_path = s_path.replace(ori_src, ori_dst, 1)
-            s_path_type = self._check_path_type(s_path, 'remote')    # 一次远非核心程调用
-            if s_path_type == 'file':
-                self._sftp_get(s_path, d_path)
-            if s_path_type == 'directory':
-                self._get_dirs(s_path, ori_src, ori_dst)
+            if stat.S_ISREG(attr.st_mode):
+                yield 'file', s_path, d_path, attr, local[name].stat() if name in local else 'no_exist'
+            if stat.S_ISDIR(attr.st_mode):
+                yield from self._get_plan(s_path, ori_src, ori_dst, attr)
+
+    def _get_dirs(self, src_dir, dst_dir, pool):
+        """逐个sftp调用的get目录: 目录在本线程中按顺序创建, 文件交由 TransferPool 并发传输"""
+        for kind, s_path, d_path, src_stat, *dst_stat in self._get_plan(src_dir, src_dir, dst_dir):
+            if kind == 'dir':
+                self._makedirs_local(d_path, s_path, src_stat)
+            else:
+                pool.submit(self._sftp_get, s_path, d_path, src_stat=src_stat, dst_stat=dst_stat[0])
+
+    def _tar_get_dirs(self, src_dir, dst_dir):
+        """--tar 模式get目录: 由 _get_plan() 选出需要传输的文件(及缺少的目录), 通过stdin把列表交给远端的 tar c,
+        从同一个exec channel读取gzip压缩的tar流并即时解包, 保留权限和mtime.
+        远端tar以 -h 打包符号链接指向的内容(与sftp方式一致), 流中的符号链接成员不解包, 以免之后的成员经由链接写到dst之外;
+        硬链接成员(-h 后同一文件的多个路径)只指向本次已解包的成员, 检查路径后在本地同样建为硬链接"""
+        names = []
+        for kind, s_path, d_path, src_stat, *dst_stat in self._get_plan(src_dir, src_dir, dst_dir):
+            if kind == 'dir' or self._changed(src_stat, dst_stat[0]):
+                names.append(s_path[len(src_dir):] or '.')
+                if kind == 'file':
+                    self._count_transferred(src_stat.st_size)
+        if not names or self.event.is_set():
+            return
+        cmd = 'tar -chzf - -C {} --no-recursion --null -T -'.format(shlex.quote(src_dir))
+        stdin_, stdout_, stderr_ = self.client.exec_command(cmd)
+
+        def feed_names():
+            # 单独的线程写入文件列表, 避免列表很长时与读取tar流互相等待
+            stdin_.write(b'\0'.join(name.encode() for name in names) + b'\0')
+            stdin_.close()
+        threading.Thread(target=feed_names, daemon=True).start()
+        os.makedirs(dst_dir, exist_ok=True)
+        with tarfile.open(fileobj=stdout_, mode='r|gz') as tar:
+            if hasattr(tarfile, 'fully_trusted_filter'):
+                tar.extraction_filter = tarfile.fully_trusted_filter    # 成员路径已在下面检查, 需要保留原有权限
+            dirs = []
+            for member in tar:
+                if any(name.startswith('/') or '..' in name.split('/') for name in (member.name, member.linkname)) or member.issym():
+                    continue
+                if member.islnk():
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(dst_dir, member.name))    # 本地的旧文件, os.link() 不会覆盖
+                tar.extract(member, dst_dir)
+                if member.isdir():
+                    dirs.append(member)
+                if member.isfile() or member.islnk():
+                    self.output.write_or_print('%s%s\n' % (INDENT_3, os.path.join(src_dir, member.name).replace('\\', '/')))
+            for member in reversed(dirs):
+                # 目录中的文件解包后目录的mtime会改变, 最后再设置一次
+                tar.utime(member, os.path.join(dst_dir, member.name))
+            tar.members.clear()
+        self._exec_check(stdout_, stderr_, 'tar -c')
     # -----子函数定义完毕-----
 
+    @timed('transfer')
     def sftp_transfer(self, source_path, destination_path, method):
         """
         文件传输的 主函数
@@ -332,19 +2003,20 @@ class AutoTask:
         client: paramiko.client.SSHClient object
         output:存储输出的对象
         """
-        with self.client:
+        start, before = time.time(), list(self.transferred)
+        with self._connection():
             try:
-                self.sftp = self.client.open_sftp()
+                self.sftp = self.sftp or self.open_sftp()    # play模式下各步骤共用一个sftp会话
             except Exception as err:
                 self.output.write_or_print('%sopen_sftp error: %s\n' % (INDENT_3, str(err)), color=31)
                 self.output.print_lock()
-                event.set()
+                self.event.set()
                 exit()
             if computer == 'Windows':
                 '''根据put或get,将windows路径中的 \ 分隔符替换为 / '''
-                if arguments["put"]:
+                if method == 'put':
                     source_path = source_path.replace('\\', '/')
-                elif arguments["get"]:
+                elif method == 'get':
                     destination_path = destination_path.replace('\\', '/')
 
             # -----上传逻辑-----
@@ -361,28 +2033,47 @@ class AutoTask:
                     '''判断source_path是文件'''
                     if destination_path.endswith('/'):
                         destination_path = os.path.join(destination_path, os.path.basename(source_path)).replace('\\', '/')
+                    self.journal = self._open_journal(os.path.dirname(destination_path) + '/')
+                    if self.journal and arguments['--trust-journal'] and self.journal.unchanged(destination_path, os.stat(source_path)):
+                        self._report_transferred(start, before)
+                        self.output.print_lock()
+                        return
                     dst_parent_type = self._check_path_type(os.path.dirname(destination_path), 'remote')    # 一次远非核心程调用
                     if dst_parent_type == 'file':
                         '''专门应对 file ----> file/ 这种情况,因为这种情况sftp对象会抛出 OSError(而非os模块抛出 FileExistsError),捕捉杀伤面太大'''
                         self.output.write_or_print("{}Error: remote {} is file\n".format(INDENT_3, os.path.dirname(destination_path)), color=31)
                         self.output.print_lock()
-                        event.set()
+                        self.event.set()
                         exit()
                     if dst_parent_type == 'no_exist':
                         self._makedirs_remote(os.path.dirname(destination_path), os.path.dirname(source_path))
-                    self._sftp_put(source_path, destination_path)
+                    parent = relay_tree.wait_parent(self.hostname) if relay_tree else None
+                    if not (parent and self._relay_put_file(parent, source_path, destination_path)):
+                        self._sftp_put(source_path, destination_path)
+                    self._save_journal()
+                    self._report_transferred(start, before)
                     self.output.print_lock()
                 elif source_type == 'directory':
                     '''判断src是目录'''
                     if not source_path.endswith('/'):
                         destination_path = os.path.join(destination_path, os.path.basename(source_path)).replace('\\', '/')
                     source_path, destination_path = self._process_arg_dir(source_path), self._process_arg_dir(destination_path)
-                    self._put_dirs(source_path, destination_path)
+                    self.journal = self._open_journal(destination_path)
+                    parent = relay_tree.wait_parent(self.hostname) if relay_tree else None
+                    if parent and self._relay_put_dirs(parent, source_path, destination_path):
+                        pass
+                    elif arguments['--tar']:
+                        self._tar_put_dirs(source_path, destination_path)
+                    else:
+                        with TransferPool(self, int(arguments['--transfers'])) as pool:
+                            self._put_dirs(source_path, destination_path, pool)
+                    self._save_journal()
+                    self._report_transferred(start, before)
                     self.output.print_lock()
                 else:
                     self.output.write_or_print('%sLocal %s is not exist\n' % (INDENT_3, source_path), color=31)
                     self.output.print_lock()
-                    event.set()
+                    self.event.set()
                     exit()
 
             # -----下载逻辑-----
@@ -401,87 +2092,381 @@ class AutoTask:
                     if dst_parent_type == 'file':
                         self.output.write_or_print("{}Error: local {} is file\n".format(INDENT_3, os.path.dirname(destination_path)), color=31)
                         self.output.print_lock()
-                        event.set()
+                        self.event.set()
                         exit()
                     if dst_parent_type == 'no_exist':
                         self._makedirs_local(os.path.dirname(destination_path), os.path.dirname(source_path))
                     self._sftp_get(source_path, destination_path)
+                    self._report_transferred(start, before)
                     self.output.print_lock()
                 elif source_type == 'directory':
                     '''判断source_path是目录'''
                     if not source_path.endswith('/'):
                         destination_path = os.path.join(destination_path, os.path.basename(source_path)).replace('\\', '/')
                     source_path, destination_path = self._process_arg_dir(source_path), self._process_arg_dir(destination_path)
-                    self._get_dirs(source_path, source_path, destination_path)
+                    if arguments['--tar']:
+                        self._tar_get_dirs(source_path, destination_path)
+                    else:
+                        with TransferPool(self, int(arguments['--transfers'])) as pool:
+                            self._get_dirs(source_path, destination_path, pool)
+                    self._report_transferred(start, before)
                     self.output.print_lock()
                 else:
                     self.output.write_or_print('%sRemote %s is not exist\n' % (INDENT_3, source_path), color=31)
                     self.output.print_lock()
-                    event.set()
+                    self.event.set()
                     exit()
 
 
-def get_keys(keys, dic=None, ret=None):
-    """
-    从长度和结构未知的字典对象中取出指定key的值(若key的值为字典，则递归展示其最小粒度的键值对)
-    keys: 可迭代容器,元素为要获取值的键
-    dic: 字典对象
-    ret: 一个外部的空集合, 用来存储得到的 k v 信息
-    """
-    for key in keys:
-        if key in dic:
-            if isinstance(dic[key], dict):
-                get_keys(dic[key].keys(), dic=dic[key], ret=ret)
+class Inventory:
+    """配置文件编译后的索引: 组名 -> 主机名集合, 主机名 -> [ip, port, user, vars].
+    索引以json保存在配置文件旁(.<配置文件名>.index), 配置文件的mtime或sha1改变时重新编译, 否则不再解析yaml.
+    主机的值为 [user@]ip[:port]; 组内的 _vars 为该组(及其子组)主机的变量; '_'开头的键为保留字, 不是组或主机,
+    其中顶层的(如 _profiles)作为全局设置保存在 settings 中"""
+    VERSION = 2
+
+    def __init__(self, conf_path):
+        self.path = conf_path
+        head, tail = os.path.split(conf_path)
+        self.index_path = os.path.join(head, '.{}.index'.format(tail))
+        self.hosts, self.groups, self.settings = self._load()
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        mtime, digest = os.stat(self.path).st_mtime_ns, hashlib.sha1(content).hexdigest()
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if (index['version'], index['mtime'], index['sha1']) == (self.VERSION, mtime, digest):
+                return index['hosts'], index['groups'], index['settings']
+        except (OSError, ValueError, KeyError):
+            pass
+        conf = yaml.safe_load(content)
+        if not isinstance(conf, dict):
+            raise ValueError('top level must be a mapping')
+        hosts, groups = {}, {}
+        self._compile(conf, {}, [], hosts, groups)
+        groups = {name: sorted(members) for name, members in groups.items()}
+        settings = {name: value for name, value in conf.items() if str(name).startswith('_')}
+        try:
+            tmp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': self.VERSION, 'mtime': mtime, 'sha1': digest, 'hosts': hosts, 'groups': groups, 'settings': settings}, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass    # 配置文件所在目录不可写时只是不缓存索引
+        return hosts, groups, settings
+
+    @classmethod
+    def _compile(cls, node, host_vars, parents, hosts, groups):
+        for name, value in node.items():
+            name = str(name)
+            if name.startswith('_'):
+                continue
+            if isinstance(value, dict) or value is None:
+                groups.setdefault(name, set())
+                value = value or {}
+                cls._compile(value, dict(host_vars, **(value.get('_vars') or {})), parents + [name], hosts, groups)
             else:
-                ret.add((key, dic[key]))
+                user, _, address = str(value).rpartition('@')
+                ip, _, port = address.partition(':')
+                hosts[name] = [ip, int(port or 22), user or None, host_vars]
+                for group in parents:
+                    groups[group].add(name)
+
+    def select(self, pattern):
+        """单个名称或模式匹配到的主机名集合, 组名和主机名均为字典查找"""
+        if pattern in self.groups:
+            return set(self.groups[pattern])
+        if pattern in self.hosts:
+            return {pattern}
+        if pattern == 'all':
+            return set(self.hosts)
+        if pattern.startswith('~'):
+            match = re.compile(pattern[1:]).fullmatch    # 与glob一致, 匹配完整的名称
+        elif any(c in pattern for c in '*?['):
+            match = lambda name: fnmatch.fnmatchcase(name, pattern)
         else:
-            for inner in dic:
-                if isinstance(dic[inner], dict):
-                    get_keys([key], dic=dic[inner], ret=ret)                    
+            return set()
+        ret = set()
+        for group, members in self.groups.items():
+            if match(group):
+                ret.update(members)
+        ret.update(host for host in self.hosts if match(host))
+        return ret
+
+    def resolve(self, targets, batch=None):
+        """targets中普通的名称/模式取并集, '&'开头的取交集, '!'开头的排除; 也可以写成 'web:&site1:!web3'.
+        batch: (k, n) 按主机名的crc32只保留第k批(共n批)
+        返回按主机名排序的 [(hostname, ip, port), ...]"""
+        selected, exclude, intersections = set(), set(), []
+        for term in (term for target in targets for term in re.split(r':(?=[&!])', target)):
+            if term.startswith('&'):
+                intersections.append(self.select(term[1:]))
+            elif term.startswith('!'):
+                exclude |= self.select(term[1:])
+            else:
+                matched = self.select(term)
+                if not matched:
+                    OutputText.print_color('No host matched: {}'.format(term), color=31)
+                selected |= matched
+        for hosts in intersections:
+            selected &= hosts
+        selected -= exclude
+        if batch:
+            k, n = batch
+            selected = {host for host in selected if zlib.crc32(host.encode()) % n == k - 1}
+        return [(host, self.hosts[host][0], self.hosts[host][1]) for host in sorted(selected)]
+
+
+def host_user(hostname):
+    """配置文件中为主机指定了user时使用之, 否则使用 -u"""
+    entry = inventory.hosts.get(hostname) if inventory else None
+    return (entry and entry[2]) or arguments['-u']
+
+
+def connect_args(hostname, port, profile=None):
+    """连接主机时 SSHClient.connect() 的参数: 用户, 认证, --conn-timeout;
+    提供profile时(直连)再加上profile的参数, 握手和认证也受 --conn-timeout 限制"""
+    timeout = float(arguments['--conn-timeout'])
+    args = dict(port=int(port), username=host_user(hostname), password=arguments['-p'], key_filename=arguments['--pkey'], timeout=timeout)
+    if profile is not None:
+        args.update(profile_connect_args(profile), banner_timeout=timeout, auth_timeout=timeout)
+    return args
+
 
-                    
 def get_host_info(targets):
-    """从配置文件中,取得要处理的host(s)/group(s)的主机名,主机ip,端口
-    targets: 待处理目标(list类型),值为 all(代表所有) 或 host(s)/group(s)"""
+    """从配置文件的索引中,取得要处理的host(s)/group(s)的主机名,主机ip,端口
+    targets: 待处理目标(list类型),值为 all(代表所有) 或 host(s)/group(s)/模式"""
+    global inventory
     try:
-        with open(arguments['-c']) as conf_content:
-            conf = yaml.load(conf_content)
+        inventory = Inventory(arguments['-c'])
     except Exception as e:
         OutputText.print_color("Can't parse config file: {}".format(e), color=31)
         exit(10)
-    if arguments['get']:
-        targets = [targets[0]]
-    info = set()
-    get_keys(targets, dic=conf, ret=info)
-    return info
+    batch = None
+    if arguments['--slice']:
+        try:
+            k, n = (int(i) for i in arguments['--slice'].split('/'))
+            assert 1 <= k <= n
+        except (ValueError, AssertionError):
+            OutputText.print_color('--slice should be k/n, 1 <= k <= n', color=31)
+            exit(1)
+        batch = (k, n)
+    return inventory.resolve(targets, batch)
+
+
+def host_path(auto_task, path):
+    """路径中的 {hostname} {ip} {port} 替换为主机的值"""
+    return path.replace('{hostname}', auto_task.hostname).replace('{ip}', auto_task.ip).replace('{port}', str(auto_task.port))
+
+
+def per_host_dst(dst, hosts):
+    """多台主机的下载各自保存到 <dst>/<hostname>/ 下, 避免相互覆盖; dst中已使用模板时不变"""
+    if len(hosts) > 1 and not any(k in dst for k in ('{hostname}', '{ip}', '{port}')):
+        return dst.rstrip('/\\') + '/{hostname}/'
+    return dst
+
+
+def load_steps(path):
+    """读取并检查play的步骤文件, 返回 [(类型, 参数, 步骤), ...]"""
+    try:
+        with open(path) as f:
+            steps = yaml.safe_load(f)
+        assert isinstance(steps, list) and steps, 'should be a non-empty list'
+        ret = []
+        for i, step in enumerate(steps, 1):
+            kinds = [kind for kind in ('cmd', 'put', 'get') if isinstance(step, dict) and kind in step]
+            assert len(kinds) == 1, 'step {} should have exactly one of cmd/put/get'.format(i)
+            value = step[kinds[0]]
+            if kinds[0] == 'cmd':
+                assert isinstance(value, str), 'step {}: cmd should be a string'.format(i)
+                assert isinstance(step.get('timeout', 0), (int, float)), 'step {}: timeout should be seconds'.format(i)
+            else:
+                if isinstance(value, dict):
+                    value = [value.get('src'), value.get('dst')]
+                assert isinstance(value, list) and len(value) == 2 and all(isinstance(v, str) for v in value), \
+                    'step {}: {} should be [<src>, <dst>]'.format(i, kinds[0])
+                value = [os.path.expanduser(value[0]) if kinds[0] == 'put' else value[0],
+                         os.path.expanduser(value[1]) if kinds[0] == 'get' else value[1]]
+            ret.append((kinds[0], value, step))
+        return ret
+    except Exception as e:
+        OutputText.print_color("Can't load step file: {}".format(e), color=31)
+        exit(10)
+
+
+def run_play(auto_task):
+    """play: 在同一个连接和sftp会话上依次执行各步骤, 不等待其他主机; 某一步出错则跳过本主机的后续步骤. 返回是否全部成功"""
+    with play_window or contextlib.nullcontext():
+        if event.is_set():    # Ctrl+C, 或失败的主机数已超过 --max-fail: 不再开始新的主机, 已开始的主机完成全部步骤
+            return False
+        if arguments['--output-dir']:    # 清空本主机上次运行留下的输出文件, 之后各步骤追加到其中
+            for suffix in ('.out', '.err'):
+                open(os.path.join(arguments['--output-dir'], auto_task.hostname + suffix), 'wb').close()
+        # 并行时各步骤分别输出, 每个步骤的标题带上主机名以便区分(汇总模式下主机名会使相同的输出无法归并)
+        label = ' [{}]'.format(auto_task.hostname) if arguments['--parallel'] and not aggregator else ''
+        for i, (kind, value, step) in enumerate(play_steps, 1):
+            desc = value if kind == 'cmd' else '{} -> {}'.format(*(host_path(auto_task, v) for v in value))
+            auto_task.output.write_or_print('{}----step {}/{}{}: {} {}\n'.format(INDENT_2, i, len(play_steps), label, kind, desc), color=36)
+            try:
+                if kind == 'cmd':
+                    auto_task.run_command(value, skip_err=step.get('skip_err'), timeout=step.get('timeout'))
+                else:
+                    auto_task.sftp_transfer(host_path(auto_task, value[0]), host_path(auto_task, value[1]), kind)
+            except SystemExit:
+                pass
+            if auto_task.event.is_set():
+                return False
+    return True
+
+
+def run_task(auto_task):
+    """区别处理 cmd put get play参数, 返回是否成功"""
+    ok = True
+    if arguments['cmd']:
+        auto_task.run_command(arguments['<command>'])
+    elif arguments['put']:
+        auto_task.sftp_transfer(arguments['<src>'], arguments['<dst>'], 'put')
+    elif arguments['get']:
+        auto_task.sftp_transfer(arguments['<src>'], host_path(auto_task, arguments['<dst>']), 'get')
+    elif arguments['play']:
+        ok = run_play(auto_task)
+    if arguments['put'] or arguments['get'] or arguments['play']:
+        with total_lock:
+            transfer_total[0] += auto_task.transferred[0]
+            transfer_total[1] += auto_task.transferred[1]
+    return ok
+
+
+def worker(host_queue):
+    """工作线程: 不断从队列中取出主机, 在本线程内完成 连接/认证/执行任务.
+    每取一台主机前都检查event, 保证出错后还未开始的主机不再处理"""
+    while not event.is_set():
+        try:
+            hostname, ip, port = host_queue.get_nowait()
+        except queue.Empty:
+            return
+        auto_task = AutoTask(hostname, ip, port)
+        if straggler_watch:
+            straggler_watch.begin(auto_task)
+        c = auto_task.create_sshclient()
+        ok = False
+        try:
+            if c == 'continue' or auto_task.dropped:
+                continue
+            elif not c:
+                if not arguments['play']:
+                    event.set()
+                    return
+                continue
+            ok = run_task(auto_task) and not auto_task.event.is_set()
+        except SystemExit:
+            # 任务内部出错时会 auto_task.event.set() 后调用exit(), 这里只结束当前主机
+            pass
+        finally:
+            if not arguments['play'] and auto_task.event.is_set() and not auto_task.dropped:
+                event.set()    # 非play模式下出错即不再开始新的主机
+            ok = ok and not auto_task.dropped
+            if straggler_watch:
+                straggler_watch.end(hostname, ok and not auto_task.failed)
+            if arguments['play']:
+                auto_task.client.close()
+                if not ok and not auto_task.dropped:    # 被中止的掉队者不计入 --max-fail
+                    with total_lock:
+                        failed_hosts.append(hostname)
+                        if len(failed_hosts) > int(arguments['--max-fail']):
+                            event.set()    # 不再开始新的主机
+            if relay_tree:
+                relay_tree.finish(hostname, ok)
+            if auto_task.stats:
+                auto_task.stats.ok = ok
+                auto_task.stats.files, auto_task.stats.bytes = auto_task.transferred
+                with total_lock:
+                    host_stats.append(auto_task.stats)
 
 
 def main():
-    global arguments
+    global arguments, relay_tree, aggregator, play_steps, play_window, bw_limits, straggler_watch
     arguments = docopt(__doc__)
     if arguments['--pkey'] == '~/.ssh/id_rsa':
         arguments['--pkey'] = os.path.join(os.path.expanduser('~'), '.ssh/id_rsa')
-    for hostname, ip_port in get_host_info(arguments['<targets>']):
-        '''循环处理每个主机'''
-        ip, port = ip_port.split(':')
-        if event.is_set():
-            break
-        auto_task = AutoTask(hostname, ip, port)
-        c = auto_task.create_sshclient()
-        if c == 'continue':
-            continue
-        elif not c:
-            break
-        # 区别处理 cmd put get参数
-        if arguments['cmd']:
-            t = threading.Thread(target=auto_task.run_command, args=(arguments['<command>'],))
-        elif arguments['put']:
-            t = threading.Thread(target=auto_task.sftp_transfer, args=(arguments['<src>'], arguments['<dst>'], 'put'))
-        elif arguments['get']:
-            t = threading.Thread(target=auto_task.sftp_transfer, args=(arguments['<src>'], arguments['<dst>'], 'get'))
+    arguments['--agent-sock'] = os.path.expanduser(arguments['--agent-sock'])
+    if arguments['--journal']:
+        arguments['--journal'] = os.path.expanduser(arguments['--journal'])
+    if arguments['--output-dir']:
+        os.makedirs(arguments['--output-dir'], exist_ok=True)
+    if arguments['agent']:
+        if not hasattr(socket, 'AF_UNIX'):
+            OutputText.print_color('agent needs unix socket, not supported on this platform', color=31)
+            exit(1)
+        ConnectionAgent(arguments['--agent-sock'], int(arguments['--idle'])).serve()
+        return
+    host_queue = queue.Queue()
+    hosts = get_host_info(arguments['<targets>'])
+    unknown = {name for name, profile in (host_profile(host[0]) for host in hosts) if profile is None}
+    if unknown:
+        OutputText.print_color('Unknown transport profile: {}'.format(', '.join(sorted(unknown))), color=31)
+        exit(1)
+    try:
+        bw_limits = load_bwlimits()
+    except ValueError as e:
+        OutputText.print_color('Bad bandwidth limit: {}'.format(e), color=31)
+        exit(1)
+    for host in hosts:
+        host_queue.put(host)
+    if arguments['--fanout']:
+        relay_tree = RelayTree(hosts, int(arguments['--fanout']))
+    if arguments['get']:
+        arguments['<dst>'] = per_host_dst(arguments['<dst>'], hosts)
+    start = time.time()
+    # 串行视为只有一个工作线程的特例; 并行时最多开启 --forks 个工作线程, 连接和任务都在工作线程内完成
+    forks = int(arguments['--forks']) if arguments['--parallel'] else 1
+    if arguments['play']:
+        play_steps = load_steps(arguments['<stepfile>'])
+        for kind, value, _ in play_steps:
+            if kind == 'get':
+                value[1] = per_host_dst(value[1], hosts)
+        if arguments['--window']:
+            play_window = threading.BoundedSemaphore(int(arguments['--window']))
+    if arguments['--aggregate']:
+        aggregator = OutputAggregator()
+    if arguments['--straggler']:
+        # 至少有 min(5, 主机数的一半) 台完成后, 中位数才有参考价值
+        straggler_watch = StragglerWatch(float(arguments['--straggler']), arguments['--drop-stragglers'], max(1, min(5, len(hosts) // 2)))
+    workers = [threading.Thread(target=worker, args=(host_queue,)) for _ in range(max(1, min(forks, host_queue.qsize())))]
+    for t in workers:
         t.start()
-        if not arguments['--parallel']:
+    try:
+        for t in workers:
+            t.join()
+    except KeyboardInterrupt:
+        if not aggregator:
+            raise
+        # 汇总模式下等待已开始的主机完成, 输出汇总结果后再退出
+        event.set()
+        OutputText.print_color('\n{}----bye----: waiting for sub_threads exit ...'.format(INDENT_1))
+        for t in workers:
             t.join()
+    if aggregator:
+        aggregator.close()
+    if straggler_watch:
+        straggler_watch.close()
+        if straggler_watch.stragglers:
+            OutputText.print_color('\n{}----stragglers{}: {} hosts: {}'.format(
+                INDENT_1, ' (dropped)' if straggler_watch.drop else '', len(straggler_watch.stragglers), compact_hosts(straggler_watch.stragglers)), color=33)
+    if failed_hosts:
+        OutputText.print_color('\n{}----failed: {} hosts: {}'.format(INDENT_1, len(failed_hosts), compact_hosts(failed_hosts)), color=31)
+    if (arguments['put'] or arguments['get'] or (play_steps and any(kind != 'cmd' for kind, _, _ in play_steps))) and len(hosts) > 1:
+        elapsed = max(time.time() - start, 0.001)
+        OutputText.print_color('\n{}----total: {} hosts, {} files, {} in {:.2f}s, {}/s'.format(
+            INDENT_1, len(hosts), transfer_total[0], human_size(transfer_total[1]), elapsed, human_size(transfer_total[1] / elapsed)), color=32)
+    if host_stats:
+        if arguments['--stats']:
+            report_stats(host_stats)
+        if arguments['--stats-file']:
+            save_stats(host_stats, arguments['--stats-file'])
 
 
 if __name__ == "__main__":
@@ -492,6 +2477,7 @@ if __name__ == "__main__":
         故而主线程会等待其子线程退出(并打印结果)后再退出.这种行为是正确的,因为一旦开始执行远程命令,即使关闭了其ssh连接,
         远程server上已开启的命令也不会因此中断,故而应该等待其完成并打印结果.
         '''
+        event.set()    # 已在执行的主机等待其完成, 队列中剩余的主机不再处理
         if threading.active_count() > 1:
             OutputText.print_color('\n{}----bye----: waiting for sub_threads exit ...'.format(INDENT_1))
         else:
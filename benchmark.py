@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Usage:
+  benchmark.py [options]
+
+Options:
+  -h --help             Show this screen
+  --hosts <num>         Number of local stand-in servers [default: 4]
+  --latency <ms>        Delay added to every sftp request and exec request on the servers [default: 0]
+  --bwlimit <bytes/s>   Bandwidth limit of each server's connection(s), 0 means unlimited [default: 0]
+  --scale <ratio>       Multiplier of the synthetic file trees' size [default: 1]
+  --scenarios <list>    Comma separated scenarios to run: cmd,small,huge,deep,logs,agent [default: cmd,small,huge,deep,agent]
+  --profiles <list>     Comma separated transport profiles of auto_task, every tree scenario runs once with each of them,
+                        results of profiles other than 'default' are named '<scenario>@<profile>' [default: default]
+  --args <args>         Extra arguments passed to every auto_task put/get, e.g. '--transfers 8' [default: ]
+  --output <file>       Save results as json to this file [default: benchmark.json]
+  --compare <file>      Compare with results saved before, exit 1 if any metric regressed more than --threshold
+  --threshold <ratio>   Allowed regression when '--compare' [default: 0.2]
+  --keep                Keep the work directory (servers' files, trees, inventory) [default: False]
+
+  Scenarios:
+  cmd                   Wall time of 'cmd' on all servers with '--parallel'
+  small                 Many small files;  huge: a few huge files;  deep: deeply nested directories;
+                        logs: compressible text files (shows the effect of compression with '--bwlimit')
+                        each tree is put to all servers, put again unchanged (resync), then get from all servers,
+                        measuring wall time, throughput and sftp requests per synced file
+  agent                 put/get of files larger than 3MB and 32MB through a running 'auto_task agent',
+                        covering pipelined and resumable sftp writes over the agent's unix socket
+
+  Notice:       Every server keeps its files under its own directory (remote '/' is mapped to it) for sftp,
+                exec commands run in that directory but see the real filesystem, so modes relying on remote
+                commands with absolute paths (--tar, --delta, --fanout) are not meaningful here
+"""
+
+"""
+本地性能测试: 在回环地址上启动若干个paramiko实现的ssh/sftp服务端(同一进程内), 可注入延迟和带宽限制,
+生成yaml主机配置和各种形态的文件树, 以子进程方式运行auto_task并计时, 结果保存为json以便与之前的结果比较
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import socket
+import random
+import logging
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from docopt import docopt
+import paramiko
+from paramiko import SSHException, ServerInterface, SFTPServerInterface, SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK
+
+AUTO_TASK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'auto_task.py')
+# 越小越好的指标, 用于 --compare
+LOWER_IS_BETTER = ('wall', 'rpc_per_file')
+
+
+class TokenBucket:
+    """按字节匀速放行, 多个连接共用时即为整台server的带宽"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.next = 0.0
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next = max(self.next, now) + size / self.rate
+            wait = self.next - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledSocket:
+    """包装服务端socket, 收发的数据都经过令牌桶"""
+    def __init__(self, sock, bucket):
+        self.sock = sock
+        self.bucket = bucket
+
+    def send(self, data):
+        sent = self.sock.send(data[:32768])
+        self.bucket.consume(sent)
+        return sent
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        self.bucket.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class BenchHost:
+    """一台模拟的server: 自己的根目录, 延迟, 带宽, 以及sftp请求计数"""
+    def __init__(self, root, latency, bwlimit, host_key):
+        self.root = root
+        self.latency = latency
+        self.bucket = TokenBucket(bwlimit)
+        self.host_key = host_key
+        self.rpc = Counter()
+        self.rpc_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def request(self, name):
+        """每个sftp请求: 计数并模拟一次往返延迟"""
+        with self.rpc_lock:
+            self.rpc[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def real(self, path):
+        return os.path.join(self.root, os.path.normpath('/' + path).lstrip('/'))
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(ThrottledSocket(sock, self.bucket))
+            transport.add_server_key(self.host_key)
+            transport.use_compression(True)    # 客户端要求压缩时才会使用
+            transport.set_subsystem_handler('sftp', SFTPServer, BenchSFTP)
+            try:
+                transport.start_server(server=BenchServer(self))
+            except (SSHException, EOFError, OSError):
+                pass
+
+
+class BenchServer(ServerInterface):
+    """接受任意用户的密码或密钥认证, exec请求在server根目录下用shell执行"""
+    def __init__(self, host):
+        self.host = host
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command), daemon=True).start()
+        return True
+
+    def _exec(self, channel, command):
+        if self.host.latency:
+            time.sleep(self.host.latency)
+        p = subprocess.Popen(command, shell=True, cwd=self.host.root, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def feed():
+            for data in iter(lambda: channel.recv(32768), b''):
+                p.stdin.write(data)
+            p.stdin.close()
+
+        def err():
+            for data in iter(lambda: p.stderr.read1(32768), b''):
+                channel.sendall_stderr(data)
+        threads = [threading.Thread(target=feed, daemon=True), threading.Thread(target=err, daemon=True)]
+        for t in threads:
+            t.start()
+        for data in iter(lambda: p.stdout.read1(32768), b''):
+            channel.sendall(data)
+        threads[1].join()
+        channel.send_exit_status(p.wait())
+        channel.close()
+
+
+class BenchHandle(SFTPHandle):
+    def __init__(self, host, flags):
+        super().__init__(flags)
+        self.host = host
+
+    def read(self, offset, length):
+        self.host.request('read')
+        return super().read(offset, length)
+
+    def write(self, offset, data):
+        self.host.request('write')
+        return super().write(offset, data)
+
+    def stat(self):
+        self.host.request('fstat')
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        self.host.request('fsetstat')
+        return SFTP_OK
+
+    def close(self):
+        self.host.request('close')
+        super().close()
+
+
+class BenchSFTP(SFTPServerInterface):
+    """把sftp路径映射到server的根目录下"""
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.host = server.host
+
+    def _call(self, name, func, *args):
+        self.host.request(name)
+        try:
+            return func(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        def listdir(real):
+            attrs = []
+            for name in os.listdir(real):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(real, name)))
+                attr.filename = name
+                attrs.append(attr)
+            return attrs
+        return self._call('opendir', listdir, self.host.real(path))
+
+    def stat(self, path):
+        return self._call('stat', lambda real: SFTPAttributes.from_stat(os.stat(real)), self.host.real(path))
+
+    def lstat(self, path):
+        return self._call('lstat', lambda real: SFTPAttributes.from_stat(os.lstat(real)), self.host.real(path))
+
+    def open(self, path, flags, attr):
+        def _open(real):
+            fd = os.open(real, flags, 0o644)
+            if flags & os.O_WRONLY:
+                mode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                mode = 'r+b'
+            else:
+                mode = 'rb'
+            handle = BenchHandle(self.host, flags)
+            handle.filename = real
+            handle.readfile = handle.writefile = os.fdopen(fd, mode)
+            return handle
+        return self._call('open', _open, self.host.real(path))
+
+    def remove(self, path):
+        return self._call('remove', lambda real: os.remove(real) or SFTP_OK, self.host.real(path))
+
+    def rename(self, oldpath, newpath):
+        return self._call('rename', lambda: os.rename(self.host.real(oldpath), self.host.real(newpath)) or SFTP_OK)
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call('posix_rename', lambda: os.replace(self.host.real(oldpath), self.host.real(newpath)) or SFTP_OK)
+
+    def mkdir(self, path, attr):
+        return self._call('mkdir', lambda real: os.mkdir(real) or SFTP_OK, self.host.real(path))
+
+    def rmdir(self, path):
+        return self._call('rmdir', lambda real: os.rmdir(real) or SFTP_OK, self.host.real(path))
+
+    def chattr(self, path, attr):
+        def setstat(real):
+            if attr.st_mode is not None:
+                os.chmod(real, attr.st_mode)
+            if attr.st_atime is not None:
+                os.utime(real, (attr.st_atime, attr.st_mtime))
+            return SFTP_OK
+        return self._call('setstat', setstat, self.host.real(path))
+
+    def canonicalize(self, path):
+        self.host.request('realpath')
+        return os.path.normpath('/' + path)
+
+
+def make_tree(root, kind, scale):
+    """生成合成的文件树, 返回 (文件数, 总字节数)"""
+    rnd = random.Random(kind)
+    files = []
+    if kind == 'small':
+        for i in range(max(1, int(2000 * scale))):
+            files.append((os.path.join(root, 'd%02d' % (i % 20), 'f%05d.txt' % i), 1024))
+    elif kind == 'huge':
+        for i in range(3):
+            files.append((os.path.join(root, 'huge%d.bin' % i), max(1, int(32 * 1024 * 1024 * scale))))
+    elif kind == 'deep':
+        # 深度为 depth 的二叉目录树, 每个目录两个文件
+        depth = max(1, int(8 * scale))
+        stack = [(root, 1)]
+        while stack:
+            path, level = stack.pop()
+            files.append((os.path.join(path, 'a.txt'), 4096))
+            files.append((os.path.join(path, 'b.txt'), 4096))
+            if level < depth:
+                stack.extend([(os.path.join(path, 'l'), level + 1), (os.path.join(path, 'r'), level + 1)])
+    elif kind == 'logs':
+        for i in range(20):
+            files.append((os.path.join(root, 'app%02d.log' % i), max(1, int(4 * 1024 * 1024 * scale))))
+    for path, size in files:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            if kind == 'logs':
+                f.write(make_log(rnd, size))
+            else:
+                f.write(rnd.randbytes(size) if size <= 1024 * 1024 else os.urandom(size))
+    return len(files), sum(size for _, size in files)
+
+
+def make_log(rnd, size):
+    """类似web访问日志的文本, 压缩率与真实日志相近"""
+    lines, total = [], 0
+    while total < size:
+        line = '2024-05-{:02d} {:02d}:{:02d}:{:02d} INFO 10.0.{}.{} GET /api/v1/items/{} status={} bytes={} rt={:.3f}\n'.format(
+            rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59), rnd.randint(0, 255), rnd.randint(1, 254),
+            rnd.randint(1, 99999), rnd.choice((200, 200, 200, 304, 404, 500)), rnd.randint(100, 65535), rnd.random()).encode()
+        lines.append(line)
+        total += len(line)
+    return b''.join(lines)[:size]
+
+
+class Benchmark:
+    def __init__(self, workdir, hosts, latency, bwlimit, extra_args):
+        self.workdir = workdir
+        self.extra_args = extra_args
+        self.trees = {}    # 已生成的文件树: 类型 -> (文件数, 总字节数)
+        host_key = paramiko.RSAKey.generate(2048)
+        self.hosts = [BenchHost(os.path.join(workdir, 'hosts', 'h%d' % i), latency, bwlimit, host_key) for i in range(hosts)]
+        self.inventory = os.path.join(workdir, 'inventory.yml')
+        with open(self.inventory, 'w') as f:
+            f.write('all:\n    bench:\n')
+            for i, host in enumerate(self.hosts):
+                f.write('        h{}: 127.0.0.1:{}\n'.format(i, host.port))
+        self.pkey = os.path.join(workdir, 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(self.pkey)
+
+    def rpc_total(self):
+        return sum(sum(host.rpc.values()) for host in self.hosts)
+
+    def auto_task(self, *args, extra=True, agent_sock=None):
+        """运行一次auto_task, 返回 (耗时, 该次运行的sftp请求数); agent_sock: 经由运行中的agent连接"""
+        cmd = [sys.executable, AUTO_TASK, '-c', self.inventory, '-u', 'bench', '-p', 'bench', '--pkey', self.pkey,
+               '--agent-sock', agent_sock or os.path.join(self.workdir, 'no_agent.sock')] + list(args)
+        if extra:
+            cmd[-2:-2] = self.extra_args    # 放在 'target all' 之前
+        rpc_before = self.rpc_total()
+        start = time.time()
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        wall = time.time() - start
+        if p.returncode != 0 or b'\033[0;31m' in p.stdout or b'Traceback' in p.stdout:
+            raise RuntimeError('auto_task failed: {}\n{}'.format(' '.join(cmd), p.stdout.decode('utf-8', 'replace')))
+        return wall, self.rpc_total() - rpc_before
+
+    def run_cmd(self):
+        wall, _ = self.auto_task('cmd', 'echo ok', '--parallel', 'target', 'all', extra=False)
+        return {'cmd.fanout': {'hosts': len(self.hosts), 'wall': round(wall, 3)}}
+
+    def run_tree(self, kind, scale, profile):
+        src = os.path.join(self.workdir, 'src', kind)
+        if kind not in self.trees:
+            self.trees[kind] = make_tree(src, kind, scale)
+        files, size = self.trees[kind]
+        total_files, total_bytes = files * len(self.hosts), size * len(self.hosts)
+        # 每个profile使用各自的目标目录, 保证每次的首次put都是完整传输
+        dst, suffix = '/data/{}/'.format(profile), '' if profile == 'default' else '@' + profile
+        results = {}
+
+        def record(name, wall, rpc, transferred):
+            results['{}.{}{}'.format(kind, name, suffix)] = {
+                'files': total_files, 'bytes': transferred, 'wall': round(wall, 3),
+                'throughput': round(transferred / max(wall, 0.001)), 'rpc_per_file': round(rpc / total_files, 2)}
+
+        wall, rpc = self.auto_task('put', src, dst, '--profile', profile, '--parallel', 'target', 'all')
+        record('put', wall, rpc, total_bytes)
+        self.link_remote(dst + kind)
+        wall, rpc = self.auto_task('put', src, dst, '--profile', profile, '--parallel', 'target', 'all')
+        record('resync', wall, rpc, 0)
+        wall, rpc = self.auto_task('get', dst + kind, os.path.join(self.workdir, 'get', profile, kind), '--profile', profile, '--parallel', 'target', 'all')
+        record('get', wall, rpc, total_bytes)
+        return results
+
+
+    def link_remote(self, path):
+        """在各server的树中加一个指向文件的相对符号链接, 之后的resync和get会经过远端的链接"""
+        for host in self.hosts:
+            root = host.real(path)
+            target = next(os.path.join(dirpath, filenames[0]) for dirpath, _, filenames in os.walk(root) if filenames)
+            if not os.path.lexists(os.path.join(root, 'latest')):
+                os.symlink(os.path.relpath(target, root), os.path.join(root, 'latest'))
+
+
+    def run_agent(self, scale):
+        """启动一个agent, 经由它put/get两个文件: 超过3MB时paramiko的流水线写入会检查socket的 recv_ready(),
+        超过32MB时auto_task改用可续传的分块写入"""
+        src = os.path.join(self.workdir, 'src', 'agent')
+        os.makedirs(src, exist_ok=True)
+        size = 0
+        for name, base, floor in (('pipelined.bin', 8, 4), ('resumable.bin', 40, 33)):
+            length = max(int(base * 1024 * 1024 * scale), floor * 1024 * 1024)
+            with open(os.path.join(src, name), 'wb') as f:
+                f.write(os.urandom(length))
+            size += length
+        total_files, total_bytes = 2 * len(self.hosts), size * len(self.hosts)
+        sock = os.path.join(self.workdir, 'agent.sock')
+        agent = subprocess.Popen([sys.executable, AUTO_TASK, 'agent', '--agent-sock', sock], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        results = {}
+        try:
+            deadline = time.time() + 10
+            while not os.path.exists(sock):
+                if time.time() > deadline or agent.poll() is not None:
+                    raise RuntimeError('agent did not start')
+                time.sleep(0.05)
+            for name, args in (('put', ('put', src, '/data/agent/')),
+                               ('get', ('get', '/data/agent/agent', os.path.join(self.workdir, 'get', 'agent')))):
+                wall, rpc = self.auto_task(*args, '--parallel', 'target', 'all', agent_sock=sock)
+                results['agent.' + name] = {'files': total_files, 'bytes': total_bytes, 'wall': round(wall, 3),
+                                            'throughput': round(total_bytes / max(wall, 0.001)), 'rpc_per_file': round(rpc / total_files, 2)}
+        finally:
+            agent.terminate()
+            agent.wait()
+        return results
+
+
+def compare(old, new, threshold):
+    """逐项比较两次结果, 返回退化的项"""
+    regressions = []
+    for name, metrics in sorted(new['results'].items()):
+        for metric in LOWER_IS_BETTER:
+            before, after = old['results'].get(name, {}).get(metric), metrics.get(metric)
+            if not before or after is None:
+                continue
+            ratio = after / before
+            flag = ' <-- regression' if ratio > 1 + threshold else ''
+            print('{:<28}{:<14}{:>12}{:>12}{:>9.2f}x{}'.format(name, metric, before, after, ratio, flag))
+            if flag:
+                regressions.append((name, metric))
+    return regressions
+
+
+def main():
+    arguments = docopt(__doc__)
+    # 客户端退出时直接断开连接, 服务端的paramiko会记录 Connection reset, 这里不需要
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+    workdir = tempfile.mkdtemp(prefix='auto_task_bench_')
+    scale = float(arguments['--scale'])
+    bench = Benchmark(workdir, int(arguments['--hosts']), int(arguments['--latency']) / 1000,
+                      int(arguments['--bwlimit']), shlex.split(arguments['--args']))
+    results = {}
+    try:
+        for scenario in arguments['--scenarios'].split(','):
+            if scenario == 'cmd':
+                results.update(bench.run_cmd())
+            elif scenario == 'agent':
+                results.update(bench.run_agent(scale))
+            else:
+                for profile in arguments['--profiles'].split(','):
+                    results.update(bench.run_tree(scenario, scale, profile))
+    finally:
+        if arguments['--keep']:
+            print('work directory: {}'.format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0], 'paramiko': paramiko.__version__,
+                       'hosts': int(arguments['--hosts']), 'latency_ms': int(arguments['--latency']), 'bwlimit': int(arguments['--bwlimit']),
+                       'scale': scale, 'args': arguments['--args'], 'profiles': arguments['--profiles']},
+              'results': results}
+    print('{:<28}{:>8}{:>14}{:>10}{:>14}{:>14}'.format('scenario', 'files', 'bytes', 'wall(s)', 'bytes/s', 'rpc/file'))
+    for name, m in sorted(results.items()):
+        print('{:<28}{:>8}{:>14}{:>10}{:>14}{:>14}'.format(name, m.get('files', ''), m.get('bytes', ''), m['wall'], m.get('throughput', ''), m.get('rpc_per_file', '')))
+    with open(arguments['--output'], 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if arguments['--compare']:
+        with open(arguments['--compare']) as f:
+            old = json.load(f)
+        print()
+        if compare(old, report, float(arguments['--threshold'])):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()